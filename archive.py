@@ -0,0 +1,214 @@
+# archive.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import quote
+import persistence
+import schema
+
+HOT_ROWS = 10000  # newest messages per room kept in the live database
+HOT_AGE = 0  # seconds; older messages are archived whatever the room's size (0: no age limit)
+COMPACT_INTERVAL = 600
+GRACE = 60  # seconds; younger rows may still be queued on another worker, so they stay hot
+SEGMENT_ROWS = 5000  # rows moved per transaction and most rows in one segment
+COMPRESS_LEVEL = 9
+CACHED_SEGMENTS = 16
+
+INDEX_SEGMENT = '''
+    INSERT INTO archive_segments (room, first_id, last_id, start_time, end_time, rows, bytes, path)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+# messages_fts has external content, so removed rows are deleted with their original text
+UNINDEX_MESSAGE = "INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', ?, ?)"
+
+
+class MessageArchive:
+    """Compressed, day-partitioned segments holding each room's oldest messages.
+
+    The compactor moves the rows past a room's hot limit (HOT_ROWS newest,
+    or younger than HOT_AGE) out of the messages table into
+    <directory>/<YYYY-MM-DD>/<room>-<first id>-<last id>.seg, indexed by the
+    archive_segments table. It always takes a room's oldest rows, so the
+    archive holds everything older than the first hot message and history
+    reads continue into it where the table ends. Decoded segments are kept
+    in a small LRU since paging back through history reads them in turn.
+    """
+
+    def __init__(self, directory='archive', db_path='chat_data.db', cached_segments=CACHED_SEGMENTS):
+        self.directory = directory
+        self.db_path = db_path
+        self.cached_segments = cached_segments
+        self.conn = persistence.connect(db_path)
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()  # {path: [(id, username, message, timestamp, type, file_id)]}
+        self.stats = {'reads': 0, 'segments_loaded': 0, 'segment_cache_hits': 0, 'compactions': 0,
+                      'rows_archived': 0, 'segments_written': 0, 'bytes_written': 0,
+                      'compact_seconds_last': 0.0, 'errors': 0}
+        self.stop = threading.Event()
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def rooms(self):
+        """Rooms with archived messages"""
+        with self.lock:
+            return [room for (room,) in self.conn.execute('SELECT DISTINCT room FROM archive_segments')]
+
+    def older(self, room, before_id, limit):
+        """Up to `limit` newest archived rows older than before_id, oldest first"""
+        with self.lock:
+            self.stats['reads'] += 1
+            segments = self.conn.execute('''
+                SELECT last_id, path FROM archive_segments
+                WHERE room=? AND first_id < ?
+                ORDER BY last_id DESC
+            ''', (room, before_id)).fetchall()
+            rows = []
+            for last_id, path in segments:
+                if len(rows) >= limit and last_id < rows[-limit][0]:
+                    break
+                rows.extend(row for row in self.segment(path) if row[0] < before_id)
+                rows.sort()
+            return rows[-limit:] if limit else []
+
+    def newer(self, room, after_id, limit, before_id=None):
+        """Up to `limit` archived rows newer than after_id (and older than before_id), oldest first"""
+        with self.lock:
+            self.stats['reads'] += 1
+            segments = self.conn.execute('''
+                SELECT first_id, path FROM archive_segments
+                WHERE room=? AND last_id > ? AND first_id < ?
+                ORDER BY first_id
+            ''', (room, after_id, before_id if before_id is not None else 2 ** 63 - 1)).fetchall()
+            rows = []
+            for first_id, path in segments:
+                if len(rows) >= limit and first_id > rows[limit - 1][0]:
+                    break
+                rows.extend(row for row in self.segment(path)
+                            if row[0] > after_id and (before_id is None or row[0] < before_id))
+                rows.sort()
+            return rows[:limit]
+
+    def segment(self, path):
+        # Caller holds self.lock
+        rows = self.segments.get(path)
+        if rows is not None:
+            self.segments.move_to_end(path)
+            self.stats['segment_cache_hits'] += 1
+            return rows
+        with open(os.path.join(self.directory, path), 'rb') as f:
+            rows = [tuple(row) for row in json.loads(zlib.decompress(f.read()))]
+        self.stats['segments_loaded'] += 1
+        self.segments[path] = rows
+        if len(self.segments) > self.cached_segments:
+            self.segments.popitem(last=False)
+        return rows
+
+    def start(self, hot_rows=HOT_ROWS, hot_age=HOT_AGE, interval=COMPACT_INTERVAL, on_archived=None):
+        """Compact every interval seconds on a background thread; on_archived(room) follows each room"""
+        if not (hot_rows or hot_age) or not interval:
+            return
+        self.thread = threading.Thread(target=self.run, args=(hot_rows, hot_age, interval, on_archived),
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self, hot_rows, hot_age, interval, on_archived):
+        conn = persistence.connect(self.db_path)
+        while not self.stop.is_set():
+            try:
+                self.compact(conn, hot_rows, hot_age, on_archived)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Archive compaction failed: {e}")
+                with self.lock:
+                    self.stats['errors'] += 1
+            self.stop.wait(interval)
+        conn.close()
+
+    def compact(self, conn, hot_rows, hot_age, on_archived=None):
+        """Move every room's rows past its hot limit into segments; returns the rows moved"""
+        started = time.perf_counter()
+        now = int(time.time())
+        moved = 0
+        for room in schema.message_rooms(conn):
+            excess = conn.execute('SELECT COUNT(*) FROM messages WHERE room=?', (room,)).fetchone()[0]
+            excess = excess - hot_rows if hot_rows else 0
+            archived = 0
+            while not self.stop.is_set():
+                rows = conn.execute('''
+                    SELECT id, username, message, timestamp, message_type, file_id
+                    FROM messages
+                    WHERE room=?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (room, SEGMENT_ROWS)).fetchall()
+                batch = []
+                for row in rows:
+                    if row[3] > now - GRACE or (excess <= 0 and not (hot_age and row[3] < now - hot_age)):
+                        break
+                    batch.append(row)
+                    excess -= 1
+                if not batch:
+                    break
+                self.archive_rows(conn, room, batch)
+                archived += len(batch)
+            if archived:
+                moved += archived
+                if on_archived:
+                    on_archived(room)
+        if moved:
+            # Fold the deletes into the database file now rather than at the next busy checkpoint
+            conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+        with self.lock:
+            self.stats['compactions'] += 1
+            self.stats['rows_archived'] += moved
+            self.stats['compact_seconds_last'] = time.perf_counter() - started
+        return moved
+
+    def archive_rows(self, conn, room, rows):
+        """Write rows (oldest first) to one segment per UTC day, then drop them from the hot tables"""
+        days = {}
+        for row in rows:
+            day = datetime.fromtimestamp(row[3], timezone.utc).strftime('%Y-%m-%d')
+            days.setdefault(day, []).append(row)
+        segments = []
+        for day, day_rows in days.items():
+            path = f"{day}/{quote(room, safe='')}-{day_rows[0][0]}-{day_rows[-1][0]}.seg"
+            data = zlib.compress(json.dumps(day_rows, separators=(',', ':')).encode(), COMPRESS_LEVEL)
+            full_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path + '.tmp', 'wb') as f:
+                f.write(data)
+                # The rows are deleted below, so the segment must be durable first
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(full_path + '.tmp', full_path)
+            segments.append((room, day_rows[0][0], day_rows[-1][0], day_rows[0][3], day_rows[-1][3],
+                             len(day_rows), len(data), path))
+
+        # A crash before this commit leaves unindexed segment files and the rows still hot
+        with conn:
+            conn.executemany(INDEX_SEGMENT, segments)
+            conn.executemany(UNINDEX_MESSAGE, [(row[0], row[2]) for row in rows])
+            conn.executemany('DELETE FROM messages WHERE id=?', [(row[0],) for row in rows])
+        with self.lock:
+            self.stats['segments_written'] += len(segments)
+            self.stats['bytes_written'] += sum(segment[6] for segment in segments)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, cached_segments=len(self.segments))
+            stats['segments'], stats['archived_rows'], stats['archive_bytes'] = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(rows), 0), COALESCE(SUM(bytes), 0) FROM archive_segments'
+            ).fetchone()
+        return stats
+
+    def close(self):
+        self.stop.set()
+        if self.thread:
+            self.thread.join(10)
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,171 @@
+# async_server.py
+import asyncio
+import concurrent.futures
+import time
+import protocol
+import outbound
+from server import ChatServer
+
+BLOCKING_WORKERS = 8  # threads for disk and database work that would stall the event loop
+
+
+class AsyncConnection:
+    """Stream connection served by the asyncio engine"""
+
+    def __init__(self, writer, address, max_frames=1024, policy=outbound.DROP_OLDEST,
+                 flush_interval=0.0, flush_bytes=outbound.FLUSH_BYTES):
+        self.writer = writer
+        self.address = address
+        self.username = None
+        self.room = None
+        self.downloads = {}  # {file_id: transfer.Download}
+        self.bytes_received = 0
+        self.last_active = time.monotonic()  # when the last frame arrived
+        self.disconnected = False
+        self.closed = False
+        self.queue = outbound.OutboundQueue(max_frames, policy)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.ready = asyncio.Event()
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    def send_frame(self, frame, key=None):
+        """Queue an encoded frame for this connection's writer task"""
+        if self.closed:
+            return
+        if not self.queue.push(frame, key):
+            # Slow consumer: abort so the reader sees the connection drop
+            self.closed = True
+            self.writer.transport.abort()
+        self.ready.set()
+
+    async def write_loop(self):
+        """Flush queued frames to the transport, waiting on drain for backpressure"""
+        # writelines hands a whole batch to the transport, which sends it in one call
+        try:
+            while True:
+                if not self.queue.depth:
+                    if self.closed:
+                        break
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if self.flush_interval and self.queue.bytes < self.flush_bytes and not self.closed:
+                    await asyncio.sleep(self.flush_interval)
+                if self.writer.is_closing():
+                    break
+                frames = self.queue.pop_batch(self.flush_bytes)
+                self.writer.writelines(frames)
+                self.queue.record_flush(frames, 1)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.queue.pop_all()
+
+    def outbound_stats(self):
+        return dict(self.queue.stats, depth=self.queue.depth)
+
+    def abort(self):
+        """Drop a dead or silent peer; the reader task then cleans up"""
+        self.writer.transport.abort()
+
+    async def close(self):
+        """Let queued frames go out, then close the transport"""
+        self.closed = True
+        self.ready.set()
+        await self.writer_task
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class AsyncChatServer(ChatServer):
+    """Chat server running every connection on one asyncio event loop"""
+
+    def __init__(self, *args, backlog=4096, blocking_workers=BLOCKING_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backlog = backlog
+        self.executor = concurrent.futures.ThreadPoolExecutor(blocking_workers,
+                                                              thread_name_prefix='blocking')
+
+    async def read_frame(self, reader):
+        """Return the next frame from a stream, or None on clean EOF"""
+        try:
+            header = await reader.readexactly(protocol.HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise protocol.FrameError("Connection closed in the middle of a frame")
+            return None
+        (length,) = protocol.HEADER.unpack(header)
+        if length > self.max_frame_size:
+            raise protocol.FrameError(f"Incoming frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        return await reader.readexactly(length)
+
+    async def handle_connection(self, reader, writer):
+        """Reader task for one client; responses go through its writer task"""
+        address = writer.get_extra_info('peername')
+        print(f"Connection from {address}")
+        conn = AsyncConnection(writer, address, self.outbound_queue_size, self.slow_consumer_policy,
+                               self.flush_interval, self.flush_bytes)
+        conn.wire = self.default_wire
+        self.watch(conn)
+
+        try:
+            # Send encryption key to client
+            conn.send_frame(protocol.encode_frame(self.encryption_key))
+
+            while True:
+                encrypted_data = await self.read_frame(reader)
+                if encrypted_data is None:
+                    break
+
+                pending = self.dispatch(conn, encrypted_data)
+                if pending:
+                    # Stop reading this client until the work is done; the loop serves the rest
+                    pending.then(await asyncio.wrap_future(pending.future))
+
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+        finally:
+            self.disconnect(conn)
+            await conn.close()
+
+    def offload(self, work, *args):
+        """Run blocking work(*args) on the executor, off the event loop; returns a future"""
+        return self.executor.submit(work, *args)
+
+    def call_soon(self, callback, *args):
+        """Hand work from another thread to the event loop"""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds on the event loop"""
+        self.loop.call_later(delay, callback, *args)
+
+    async def serve(self):
+        """Accept connections until cancelled"""
+        self.loop = asyncio.get_running_loop()
+        self.connect_bus()
+        self.start_metrics()
+        self.start_heartbeat()
+        self.start_upload_sweep()
+        self.server.bind((self.host, self.port))
+        self.server.listen(self.backlog)
+        self.server.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server)
+        print(f"Server started on {self.host}:{self.port} (asyncio)")
+
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        """Start the chat server on a fresh event loop"""
+        asyncio.run(self.serve())
+
+    def close(self):
+        self.executor.shutdown()
+        super().close()
@@ -0,0 +1,170 @@
+# auth.py
+import hashlib
+import hmac
+import os
+import base64
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import persistence
+
+KDF_ITERATIONS = 600000
+SESSION_TTL = 24 * 3600
+PRUNE_INTERVAL = 60
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+class Authenticator:
+    """Password registration and login checks, run off the connection handlers.
+
+    Passwords are stored as salted PBKDF2-SHA256. Hashing runs in a bounded
+    thread pool (hashlib releases the GIL while it works), so a burst of logins
+    queues there instead of stalling message handling. A successful login
+    issues a session token; presenting it later costs one SHA-256 and a dict
+    lookup, and tokens are persisted so they survive a server restart.
+    """
+
+    def __init__(self, db_path, workers=4, iterations=KDF_ITERATIONS, session_ttl=SESSION_TTL):
+        self.db_path = db_path
+        self.iterations = iterations
+        self.session_ttl = session_ttl
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = {}  # {sha256(token): (username, expires_at)}
+        self.last_prune = time.time()
+        self.stats = {'kdf_hashes': 0, 'password_logins': 0, 'token_logins': 0,
+                      'failed_logins': 0, 'rehashed': 0}
+        # Unknown users are checked against this so they cost the same as real ones
+        self.dummy_hash = self.hash_password(secrets.token_hex(16), count=False)
+        self.load_sessions()
+
+    def connection(self):
+        """Per-worker SQLite connection, so lookups keep their prepared statements"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = persistence.connect(self.db_path)
+        return conn
+
+    def hash_password(self, password, salt=None, iterations=None, count=True):
+        salt = salt or os.urandom(16)
+        iterations = iterations or self.iterations
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        if count:
+            with self.lock:
+                self.stats['kdf_hashes'] += 1
+        return f"pbkdf2_sha256${iterations}${b64(salt)}${b64(digest)}"
+
+    def verify_password(self, password, stored):
+        """Check a password against a stored hash; also accepts legacy unsalted SHA-256"""
+        if stored.startswith('pbkdf2_sha256$'):
+            _, iterations, salt, _ = stored.split('$')
+            candidate = self.hash_password(password, base64.b64decode(salt), int(iterations))
+            return hmac.compare_digest(candidate, stored)
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+    def register(self, username, password):
+        """Future resolving to (success, message)"""
+        return self.pool.submit(self.register_sync, username, password)
+
+    def register_sync(self, username, password):
+        try:
+            hashed_pw = self.hash_password(password)
+            with self.connection() as conn:
+                conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                             (username, hashed_pw))
+            return True, "Registration successful!"
+        except sqlite3.IntegrityError:
+            return False, "Username already exists!"
+        except Exception as e:
+            return False, f"Registration failed: {str(e)}"
+
+    def authenticate(self, username, password):
+        """Future resolving to True when the password matches"""
+        return self.pool.submit(self.authenticate_sync, username, password)
+
+    def authenticate_sync(self, username, password):
+        conn = self.connection()
+        row = conn.execute('SELECT password FROM users WHERE username=?', (username,)).fetchone()
+        stored = row[0] if row else self.dummy_hash
+        valid = self.verify_password(password, stored) and row is not None
+
+        if valid and not stored.startswith(f"pbkdf2_sha256${self.iterations}$"):
+            # Legacy or weaker hash: upgrade it now that we know the password
+            with conn:
+                conn.execute('UPDATE users SET password=? WHERE username=?',
+                             (self.hash_password(password), username))
+            with self.lock:
+                self.stats['rehashed'] += 1
+
+        with self.lock:
+            self.stats['password_logins' if valid else 'failed_logins'] += 1
+        return valid
+
+    def issue_token(self, username):
+        """Create a session token for a user who just logged in"""
+        token = secrets.token_urlsafe(32)
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        expires_at = int(time.time()) + self.session_ttl
+        with self.lock:
+            self.sessions[token_hash] = (username, expires_at)
+        self.pool.submit(self.store_session, token_hash, username, expires_at)
+        self.prune()
+        return token
+
+    def verify_token(self, username, token):
+        """Cheap check of a session token; no KDF involved"""
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        with self.lock:
+            session = self.sessions.get(token_hash)
+        if session is None:
+            # Issued by another worker of the cluster; one indexed lookup
+            session = self.connection().execute(
+                'SELECT username, expires_at FROM sessions WHERE token_hash=?', (token_hash,)).fetchone()
+        valid = session is not None and session[0] == username and session[1] > time.time()
+        with self.lock:
+            if valid:
+                self.sessions[token_hash] = tuple(session)
+            self.stats['token_logins' if valid else 'failed_logins'] += 1
+        return valid
+
+    def store_session(self, token_hash, username, expires_at):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (token_hash, username, expires_at) VALUES (?, ?, ?)',
+                         (token_hash, username, expires_at))
+
+    def load_sessions(self):
+        conn = persistence.connect(self.db_path)
+        rows = conn.execute('SELECT token_hash, username, expires_at FROM sessions WHERE expires_at > ?',
+                            (int(time.time()),)).fetchall()
+        conn.close()
+        self.sessions = {token_hash: (username, expires_at) for token_hash, username, expires_at in rows}
+
+    def prune(self):
+        """Forget expired sessions, at most once per PRUNE_INTERVAL"""
+        now = time.time()
+        with self.lock:
+            if now - self.last_prune < PRUNE_INTERVAL:
+                return
+            self.last_prune = now
+            expired = [key for key, (_, expires_at) in self.sessions.items() if expires_at <= now]
+            for key in expired:
+                del self.sessions[key]
+        self.pool.submit(self.delete_expired, int(now))
+
+    def delete_expired(self, now):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, sessions=len(self.sessions),
+                        queued=self.pool._work_queue.qsize())
+
+    def close(self):
+        self.pool.shutdown(wait=True)
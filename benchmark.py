@@ -0,0 +1,476 @@
+# benchmark.py
+# Repeatable micro-benchmarks for the chat server's hot paths.
+#   python benchmark.py codecs      bytes per message and encode/decode time per wire format
+#   python benchmark.py load        simulated clients against a server: throughput, fan-out latency, CPU, RSS
+#   python benchmark.py suite       fixed load scenarios against local servers, compared to a saved baseline
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import os
+from cryptography.fernet import Fernet
+import codec
+import protocol
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MARKER = 'bench'  # load messages carry "bench <send time>" so receivers can time the fan-out
+PASSWORD = 'load-password'
+CONNECT_CONCURRENCY = 100  # handshakes in flight while clients log in
+DRAIN_SECONDS = 2.0  # wait after the last send for in-flight deliveries
+BENCH_KDF_ITERATIONS = 1000  # local servers hash cheaply so logging in thousands of users is quick
+SERVER_START_TIMEOUT = 15
+
+# (name, clients, rooms, messages/sec per client, a file every N messages, file size)
+SUITE = [
+    ('chat', 200, 20, 1.0, 0, 0),
+    ('busy-room', 100, 1, 0.5, 0, 0),
+    ('files', 50, 5, 1.0, 5, 16 * 1024),
+]
+# Higher is better for throughput; lower is better for everything else compared
+HIGHER_IS_BETTER = ('delivered_per_sec',)
+COMPARED = ('delivered_per_sec', 'p50_ms', 'p99_ms', 'server_cpu_percent', 'server_rss_mb')
+
+
+class PlainCipher:
+    """No encryption, to separate serializer cost from cipher cost"""
+
+    name = 'none'
+
+    def encrypt(self, data):
+        return data
+
+    def decrypt(self, data):
+        return data
+
+
+def sample_messages():
+    """Representative frames: a chat line, a join with history, and a file chunk"""
+    new_message = {
+        'action': 'new_message',
+        'id': 1048576,
+        'username': 'alice',
+        'message': 'Has anyone tried the new build on staging yet? 🔥',
+        'type': 'text',
+        'timestamp': '2025-01-01 12:00:00'
+    }
+    history = [
+        ('user%d' % (i % 7), 'message number %d with some typical chat text' % i,
+         '2025-01-01 12:00:00', 'text', 1048000 + i, None)
+        for i in range(50)
+    ]
+    room_joined = {
+        'action': 'room_joined',
+        'room': 'General',
+        'history': history,
+        'next_before_id': 1048000,
+        'users': ['user%d' % i for i in range(40)]
+    }
+    file_chunk = {
+        'action': 'file_chunk',
+        'file_id': '0123456789abcdef0123456789abcdef',
+        'offset': 65536,
+        'size': 1 << 20,
+        'chunk': os.urandom(64 * 1024)
+    }
+    return {'new_message': new_message, 'room_joined': room_joined, 'file_chunk': file_chunk}
+
+
+def wire_formats():
+    fernet = codec.FernetCipher(Fernet.generate_key())
+    aesgcm = codec.AesGcmCipher()
+    formats = []
+    for cipher in (PlainCipher(), fernet, aesgcm):
+        for serializer in (codec.JsonCodec(), codec.BinaryCodec()):
+            formats.append(codec.WireFormat(serializer, cipher))
+    # Compression only changes the body the cipher sees, so one cipher shows its effect
+    for compressor in codec.COMPRESSORS.values():
+        for serializer in (codec.JsonCodec(), codec.BinaryCodec()):
+            formats.append(codec.WireFormat(serializer, aesgcm, compressor()))
+    return formats
+
+
+def time_per_call(func, arg, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - started) / iterations
+
+
+def bench_codecs(args):
+    implementation = 'msgpack C extension' if codec.msgpack else 'pure Python MessagePack'
+    print(f"Binary codec: {implementation}; {args.iterations} iterations per cell\n")
+    print(f"{'message':<12} {'format':<26} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+
+    for sample, message in sample_messages().items():
+        iterations = max(1, args.iterations // 20) if sample == 'file_chunk' else args.iterations
+        for wire in wire_formats():
+            data = wire.encode(message)
+            assert wire.decode(data)['action'] == message['action']
+            encode = time_per_call(wire.encode, message, iterations)
+            decode = time_per_call(wire.decode, data, iterations)
+            print(f"{sample:<12} {wire.name:<26} {len(data):>8} {encode * 1e6:>10.1f} {decode * 1e6:>10.1f}")
+        print()
+
+
+class LoadStats:
+    """Counters shared by every simulated client; only the measured window is recorded"""
+
+    def __init__(self):
+        self.measuring = False
+        self.sent = 0
+        self.expected = 0  # deliveries the sends should cause: one per other member of the room
+        self.delivered = 0
+        self.latencies = []
+        self.throttled = 0  # sends the server answered with rate_limited
+        self.errors = 0
+
+
+class LoadClient:
+    """One simulated user speaking the real protocol over an asyncio stream"""
+
+    def __init__(self, username, room, room_size, stats):
+        self.username = username
+        self.room = room
+        self.room_size = room_size
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.wire = None
+
+    async def read_frame(self):
+        header = await self.reader.readexactly(protocol.HEADER.size)
+        (length,) = protocol.HEADER.unpack(header)
+        return await self.reader.readexactly(length)
+
+    def send(self, message):
+        self.writer.write(protocol.encode_frame(self.wire.encode(message)))
+
+    async def request(self, message, reply):
+        """Send a request and skip unrelated traffic (presence, other rooms) until its reply"""
+        self.send(message)
+        while True:
+            data = self.wire.decode(await self.read_frame())
+            if data.get('action') == reply:
+                return data
+
+    async def start(self, host, port, gate):
+        """Connect, negotiate the wire format, register or log in, and join the room"""
+        async with gate:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            self.wire = codec.WireFormat(codec.JsonCodec(), codec.FernetCipher(await self.read_frame()))
+            response = await self.request({'action': 'hello', 'codecs': list(codec.PREFERRED_CODECS),
+                                           'ciphers': list(codec.CIPHERS),
+                                           'compression': list(codec.COMPRESSORS)}, 'hello_response')
+            cipher = self.wire.cipher
+            if response['cipher'] == 'aesgcm':
+                cipher = codec.AesGcmCipher(codec.decode_key(response['key']))
+            compression = response.get('compression')
+            compressor = codec.COMPRESSORS[compression]() if compression else None
+            self.wire = codec.WireFormat(codec.CODECS[response['codec']](), cipher, compressor)
+
+            # Registering an existing user just fails, so runs can share a database
+            await self.request({'action': 'register', 'username': self.username,
+                                'password': PASSWORD}, 'register_response')
+            response = await self.request({'action': 'login', 'username': self.username,
+                                           'password': PASSWORD}, 'login_response')
+            if not response['success']:
+                raise RuntimeError(f"{self.username} could not log in: {response['message']}")
+            await self.request({'action': 'join_room', 'room': self.room}, 'room_joined')
+
+    async def receive_loop(self):
+        stats = self.stats
+        try:
+            while True:
+                data = self.wire.decode(await self.read_frame())
+                action = data.get('action')
+                if action == 'ping':
+                    self.send({'action': 'pong'})
+                    continue
+                if action == 'rate_limited':
+                    if stats.measuring:
+                        # It will never be delivered, so it is no longer expected
+                        stats.throttled += 1
+                        stats.expected -= self.room_size - 1
+                    continue
+                if action == 'new_message':
+                    stamp = data['message']
+                elif action == 'new_file':
+                    stamp = data['filename'].rsplit('.', 1)[0]
+                else:
+                    continue
+                if stats.measuring and stamp.startswith(MARKER):
+                    stats.delivered += 1
+                    stats.latencies.append(time.perf_counter() - float(stamp.split()[1]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            stats.errors += 1
+
+    async def send_loop(self, rate, deadline, file_every, file_data):
+        interval = 1 / rate
+        # Spread the clients out instead of sending in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        count = 0
+        try:
+            while time.perf_counter() < deadline:
+                count += 1
+                stamp = f"{MARKER} {time.perf_counter():.6f}"
+                if file_every and count % file_every == 0:
+                    self.send({'action': 'send_file', 'room': self.room,
+                               'filename': f"{stamp}.bin", 'filedata': file_data})
+                else:
+                    self.send({'action': 'send_message', 'room': self.room,
+                               'message': stamp, 'type': 'text'})
+                self.stats.sent += 1
+                self.stats.expected += self.room_size - 1
+                await self.writer.drain()
+                await asyncio.sleep(interval)
+        except ConnectionError:
+            self.stats.errors += 1
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+def process_usage(pid):
+    """(CPU seconds, RSS bytes) of a process from /proc, or None where that is unavailable"""
+    if pid is None:
+        return None
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_load(host, port, clients, rooms, rate, duration, file_every=0, file_size=0,
+                   server_pid=None):
+    """Connect `clients` users spread over `rooms`, send for `duration` seconds, and report"""
+    stats = LoadStats()
+    sizes = [clients // rooms + (1 if room < clients % rooms else 0) for room in range(rooms)]
+    users = [LoadClient(f"load{i:05d}", f"load-room-{i % rooms}", sizes[i % rooms], stats)
+             for i in range(clients)]
+    file_data = base64.b64encode(os.urandom(file_size)).decode() if file_every else None
+
+    started = time.perf_counter()
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    await asyncio.gather(*(user.start(host, port, gate) for user in users))
+    setup = time.perf_counter() - started
+    receivers = [asyncio.create_task(user.receive_loop()) for user in users]
+
+    server_before = process_usage(server_pid)
+    cpu_before = time.process_time()
+    stats.measuring = True
+    started = time.perf_counter()
+    await asyncio.gather(*(user.send_loop(rate, started + duration, file_every, file_data)
+                           for user in users))
+    await asyncio.sleep(DRAIN_SECONDS)
+    stats.measuring = False
+    elapsed = time.perf_counter() - started
+    server_after = process_usage(server_pid)
+    loadgen_cpu = time.process_time() - cpu_before
+
+    for user in users:
+        user.close()
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    report = {
+        'clients': clients,
+        'rooms': rooms,
+        'setup_seconds': setup,
+        'sent_per_sec': stats.sent / duration,
+        'delivered_per_sec': stats.delivered / duration,
+        'delivery_ratio': stats.delivered / stats.expected if stats.expected else 1.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'loadgen_cpu_percent': loadgen_cpu / elapsed * 100,
+        'throttled': stats.throttled,
+        'errors': stats.errors,
+    }
+    if server_before and server_after:
+        report['server_cpu_percent'] = (server_after[0] - server_before[0]) / elapsed * 100
+        report['server_rss_mb'] = server_after[1] / (1 << 20)
+    return report
+
+
+def print_report(report):
+    print(f"clients {report['clients']} in {report['rooms']} rooms, logged in after {report['setup_seconds']:.1f}s")
+    print(f"sent       {report['sent_per_sec']:>10.0f} msg/s")
+    print(f"delivered  {report['delivered_per_sec']:>10.0f} msg/s  ({report['delivery_ratio']:.1%} of expected)")
+    print(f"fan-out    p50 {report['p50_ms']:.1f} ms  p99 {report['p99_ms']:.1f} ms  max {report['max_ms']:.1f} ms")
+    if 'server_cpu_percent' in report:
+        print(f"server     {report['server_cpu_percent']:.0f}% CPU  {report['server_rss_mb']:.0f} MB RSS")
+    print(f"loadgen    {report['loadgen_cpu_percent']:.0f}% CPU  {report['errors']} errors  "
+          f"{report['throttled']} sends rate limited")
+    if report['loadgen_cpu_percent'] > 90:
+        print("warning: the load generator was CPU bound; latencies include its own queueing")
+
+
+def raise_file_limit():
+    """Thousands of clients need more descriptors than the usual soft limit of 1024"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_server(engine, extra_args=()):
+    """Run server.py in a scratch directory; yields (port, pid)"""
+    directory = tempfile.mkdtemp(prefix='chat-bench-')
+    port = free_port()
+    command = [sys.executable, os.path.join(HERE, 'server.py'), '--engine', engine,
+               '--port', str(port), '--db', os.path.join(directory, 'chat_data.db'),
+               '--upload-dir', os.path.join(directory, 'uploads'),
+               '--blob-dir', os.path.join(directory, 'blobs'),
+               '--kdf-iterations', str(BENCH_KDF_ITERATIONS), *extra_args]
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with status {process.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"server did not listen on port {port}")
+                time.sleep(0.1)
+        yield port, process.pid
+    finally:
+        # The scratch directory is deleted, so nothing needs flushing on the way out
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_load(args):
+    raise_file_limit()
+    load = (args.clients, args.rooms, args.rate, args.duration, args.file_every, args.file_size)
+    if args.port:
+        report = asyncio.run(run_load(args.host, args.port, *load, server_pid=args.server_pid))
+    else:
+        with local_server(args.engine, args.server_args.split()) as (port, pid):
+            report = asyncio.run(run_load('127.0.0.1', port, *load, server_pid=pid))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing every metric that got worse than the baseline by more than tolerance"""
+    regressions = []
+    for key, report in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        for metric in COMPARED:
+            if metric not in report or not old.get(metric):
+                continue
+            change = (report[metric] - old[metric]) / old[metric]
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{key} {metric}: {old[metric]:.1f} -> {report[metric]:.1f}")
+    return regressions
+
+
+def bench_suite(args):
+    raise_file_limit()
+    results = {}
+    print(f"{'scenario':<22} {'msg/s':>9} {'ratio':>7} {'p50 ms':>8} {'p99 ms':>8} {'CPU %':>6} {'RSS MB':>7}")
+    for engine in args.engines.split(','):
+        for name, clients, rooms, rate, file_every, file_size in SUITE:
+            with local_server(engine) as (port, pid):
+                report = asyncio.run(run_load('127.0.0.1', port, clients, rooms, rate, args.duration,
+                                              file_every, file_size, server_pid=pid))
+            key = f"{engine}/{name}"
+            results[key] = report
+            print(f"{key:<22} {report['delivered_per_sec']:>9.0f} {report['delivery_ratio']:>7.1%} "
+                  f"{report['p50_ms']:>8.1f} {report['p99_ms']:>8.1f} "
+                  f"{report.get('server_cpu_percent', 0):>6.0f} {report.get('server_rss_mb', 0):>7.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    codecs = commands.add_parser('codecs', help='compare wire formats')
+    codecs.add_argument('--iterations', type=int, default=2000)
+    codecs.set_defaults(func=bench_codecs)
+
+    load = commands.add_parser('load', help='simulate clients against a server')
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, help='existing server; by default a local one is started')
+    load.add_argument('--server-pid', type=int, help='process to sample CPU and RSS from with --port')
+    load.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded')
+    load.add_argument('--server-args', default='', help='extra options for the local server')
+    load.add_argument('--clients', type=int, default=1000)
+    load.add_argument('--rooms', type=int, default=50)
+    load.add_argument('--rate', type=float, default=0.5, help='messages per second per client')
+    load.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    load.add_argument('--file-every', type=int, default=0, help='send_file instead of every Nth message')
+    load.add_argument('--file-size', type=int, default=16 * 1024)
+    load.add_argument('--output', help='write the report as JSON')
+    load.set_defaults(func=bench_load)
+
+    suite = commands.add_parser('suite', help='fixed load scenarios against local servers')
+    suite.add_argument('--engines', default='threaded,asyncio')
+    suite.add_argument('--duration', type=float, default=10)
+    suite.add_argument('--output', help='write results as JSON, usable later as a baseline')
+    suite.add_argument('--baseline', help='results JSON to compare against; exits 1 on regressions')
+    suite.add_argument('--tolerance', type=float, default=0.2,
+                       help='fraction a metric may worsen before it counts as a regression')
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# blobstore.py
+import os
+import mmap
+import threading
+import time
+from collections import OrderedDict
+import persistence
+
+
+class BlobStore:
+    """Content-addressed file storage with deduplication.
+
+    Each distinct content is stored once as <directory>/<aa>/<sha256>. Every
+    uploaded file gets a record pointing at its blob, so the same file posted
+    ten times is stored once and stays retrievable from history. File
+    messages are never deleted (archived ones still link their files), so
+    blobs are kept for good. Reads go through a
+    small LRU of memory maps, so chunked downloads slice pages the kernel
+    already has cached instead of doing an open/seek/read per chunk.
+    """
+
+    def __init__(self, directory='blobs', db_path='chat_data.db', max_open_maps=64):
+        self.directory = directory
+        self.max_open_maps = max_open_maps
+        self.conn = persistence.connect(db_path)
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()  # {digest: (file, mmap)}
+        self.info = {}  # {file_id: file record}, filled on first lookup
+        self.stats = {'blobs_written': 0, 'dedup_hits': 0, 'bytes_deduplicated': 0,
+                      'bytes_served': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def add_file(self, file_id, path, filename, username, digest):
+        """Take ownership of a completed upload, keeping only one copy of its content;
+        digest is the SHA-256 the server computed while receiving it"""
+        size = os.path.getsize(path)
+        with self.lock, self.conn:
+            if self.conn.execute('SELECT 1 FROM blobs WHERE hash=?', (digest,)).fetchone():
+                os.remove(path)
+                self.stats['dedup_hits'] += 1
+                self.stats['bytes_deduplicated'] += size
+            else:
+                os.makedirs(os.path.dirname(self.blob_path(digest)), exist_ok=True)
+                os.replace(path, self.blob_path(digest))
+                self.conn.execute('INSERT INTO blobs (hash, size) VALUES (?, ?)', (digest, size))
+                self.stats['blobs_written'] += 1
+            self.conn.execute('''
+                INSERT INTO files (file_id, hash, filename, size, username, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (file_id, digest, filename, size, username, int(time.time())))
+        info = {'file_id': file_id, 'hash': digest, 'filename': filename, 'size': size}
+        self.info[file_id] = info
+        return info
+
+    def file_info(self, file_id):
+        """File record {file_id, hash, filename, size}, or None if unknown"""
+        info = self.info.get(file_id)
+        if info is None:
+            with self.lock:
+                row = self.conn.execute('SELECT hash, filename, size FROM files WHERE file_id=?',
+                                        (file_id,)).fetchone()
+            if row is None:
+                return None
+            info = {'file_id': file_id, 'hash': row[0], 'filename': row[1], 'size': row[2]}
+            self.info[file_id] = info
+        return info
+
+    def read(self, file_id, offset, length):
+        """Read part of a file's content through a cached memory map"""
+        info = self.file_info(file_id)
+        if info is None or info['size'] == 0:
+            return b''
+        with self.lock:
+            view = self.mapping(info['hash'])
+            chunk = view[offset:offset + length]
+            self.stats['bytes_served'] += len(chunk)
+        return chunk
+
+    def mapping(self, digest):
+        # Caller holds self.lock
+        if digest in self.maps:
+            self.maps.move_to_end(digest)
+            return self.maps[digest][1]
+        f = open(self.blob_path(digest), 'rb')
+        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[digest] = (f, view)
+        if len(self.maps) > self.max_open_maps:
+            self.unmap(next(iter(self.maps)))
+        return view
+
+    def unmap(self, digest):
+        f, view = self.maps.pop(digest)
+        view.close()
+        f.close()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, open_maps=len(self.maps))
+            stats['blobs'], stats['blob_bytes'] = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        return stats
+
+    def close(self):
+        with self.lock:
+            for digest in list(self.maps):
+                self.unmap(digest)
+            self.conn.close()
@@ -3,13 +3,28 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 import socket
 import threading
-import json
-import base64
 from datetime import datetime
-from cryptography.fernet import Fernet
-from PIL import Image, ImageTk
-import io
+import protocol
+import codec
+import transfer
+import thumbnails
+import uuid
+import bisect
+import queue
+from collections import deque
+from PIL import ImageTk
 import os
+import time
+
+RECONNECT_DELAY = 1000  # ms before the first reconnect attempt; doubles up to RECONNECT_MAX
+RECONNECT_MAX = 30000
+INBOUND_TICK = 30  # ms between drains of the inbound queue on the Tk thread
+INBOUND_BATCH = 500  # messages applied per drain, so one burst cannot stall the UI
+MAX_RENDERED_LINES = 2000  # older lines are trimmed and reloaded on scroll
+HEARTBEAT_INTERVAL = 15000  # ms of silence from the server before we ping it
+SERVER_TIMEOUT = 45  # seconds without any frame before the connection is treated as dead
+# Handled on the network thread: no widgets involved and they pace transfers or liveness
+NETWORK_ACTIONS = ('upload_ack', 'file_chunk', 'ping')
 
 class ChatClient:
     def __init__(self, root):
@@ -19,10 +34,32 @@ class ChatClient:
         self.root.configure(bg='#2c3e50')
         
         self.socket = None
-        self.cipher = None
+        self.reader = None
+        self.wire = None  # negotiated codec + cipher
         self.username = None
+        self.session_token = None  # lets a reconnect log in without re-hashing the password
+        self.last_seen = {}  # {room: newest message ID shown}, sent when resuming
+        self.reconnect_delay = RECONNECT_DELAY
+        self.last_received = time.monotonic()
         self.current_room = None
+        self.room_users = []  # sorted mirror of the user list box
+        self.presence_version = None
+        self.search_window = None
         self.unread_messages = 0
+        self.history_cursor = None  # before_id of the next older history page
+        self.loading_history = False
+        self.send_lock = threading.Lock()  # upload threads share the socket with the UI
+        self.uploads = {}  # {file_id: upload state}, kept until the server confirms completion
+        self.downloads = {}  # {file_id: download state}
+        self.file_marks = {}  # {file_id: text mark where its preview goes}
+        self.previews = {}  # {file_id: PhotoImage in the chat}; Tk drops images nobody references
+        self.upload_cond = threading.Condition()
+        self.inbound = queue.Queue()  # server messages waiting for the Tk thread
+        self.rendering = False  # True while a drain batches chat output
+        self.render_chunks = []  # (text, tags, ...) for the next chat insert
+        self.render_after = []  # callbacks run once those chunks are in the widget
+        self.rendered = deque()  # [message_id, lines, file_id] per chat entry, top to bottom
+        self.thumbnails = thumbnails.ThumbnailDecoder(self.inbound.put)
         
         # Emoji dictionary
         self.emojis = {
@@ -33,6 +70,8 @@ class ChatClient:
         }
         
         self.show_login_screen()
+        self.root.after(INBOUND_TICK, self.drain_inbound)
+        self.root.after(HEARTBEAT_INTERVAL, self.check_connection)
         
     def show_login_screen(self):
         """Display login/registration screen"""
@@ -77,44 +116,140 @@ class ChatClient:
         # Bind Enter key
         self.password_entry.bind('<Return>', lambda e: self.login())
         
-    def connect_to_server(self):
+    def connect_to_server(self, quiet=False):
         """Connect to chat server"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect(('127.0.0.1', 5555))
             
+            self.reader = protocol.FrameReader(self.socket)
+            
             # Receive encryption key
-            key = self.socket.recv(1024)
-            self.cipher = Fernet(key)
+            key = self.reader.read_frame()
+            self.wire = codec.WireFormat(codec.JsonCodec(), codec.FernetCipher(key))
+            self.negotiate_format()
             return True
         except Exception as e:
-            messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
+            if not quiet:
+                messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
             return False
     
+    def negotiate_format(self):
+        """Switch to the most compact codec and cipher the server supports"""
+        self.send_data({
+            'action': 'hello',
+            'codecs': list(codec.PREFERRED_CODECS),
+            'ciphers': list(codec.CIPHERS),
+            'compression': list(codec.COMPRESSORS)
+        })
+        response = self.wire.decode(self.reader.read_frame())
+        
+        if response['cipher'] == 'aesgcm':
+            cipher = codec.AesGcmCipher(codec.decode_key(response['key']))
+        else:
+            cipher = self.wire.cipher
+        compression = response.get('compression')
+        compressor = codec.COMPRESSORS[compression]() if compression else None
+        self.wire = codec.WireFormat(codec.CODECS[response['codec']](), cipher, compressor)
+    
     def send_data(self, data):
         """Send encrypted data to server"""
-        encrypted = self.cipher.encrypt(json.dumps(data).encode())
-        self.socket.send(encrypted)
+        encrypted = self.wire.encode(data)
+        with self.send_lock:
+            protocol.send_frame(self.socket, encrypted)
     
     def receive_data(self):
         """Receive and decrypt data from server"""
         while True:
             try:
-                encrypted_data = self.socket.recv(4096)
-                if not encrypted_data:
+                encrypted_data = self.reader.read_frame()
+                if encrypted_data is None:
                     break
                 
-                data = json.loads(self.cipher.decrypt(encrypted_data).decode())
-                self.handle_server_response(data)
+                self.last_received = time.monotonic()
+                data = self.wire.decode(encrypted_data)
+                if data.get('action') in NETWORK_ACTIONS:
+                    self.handle_server_response(data)
+                else:
+                    # Tk is not thread-safe; the main loop applies it on its next tick
+                    self.inbound.put(data)
             except Exception as e:
                 print(f"Error receiving data: {e}")
                 break
+        
+        self.inbound.put({'action': 'connection_lost'})
+    
+    def drain_inbound(self):
+        """Apply queued server messages on the Tk thread, rendering the chat once per tick"""
+        try:
+            self.rendering = True
+            for _ in range(INBOUND_BATCH):
+                try:
+                    data = self.inbound.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    self.handle_server_response(data)
+                except Exception as e:
+                    print(f"Error handling {data.get('action')}: {e}")
+            self.rendering = False
+            self.flush_render()
+        finally:
+            self.rendering = False
+            self.root.after(INBOUND_TICK, self.drain_inbound)
+    
+    def check_connection(self):
+        """Ping a quiet server, and drop a connection that stopped answering so we reconnect"""
+        try:
+            if self.session_token and self.socket:
+                silent = time.monotonic() - self.last_received
+                if silent > SERVER_TIMEOUT:
+                    # Wakes receive_data, which reports connection_lost
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                elif silent * 1000 >= HEARTBEAT_INTERVAL:
+                    self.send_data({'action': 'ping'})
+        except OSError:
+            pass
+        finally:
+            self.root.after(HEARTBEAT_INTERVAL, self.check_connection)
+    
+    def start_receiving(self):
+        self.last_received = time.monotonic()
+        receive_thread = threading.Thread(target=self.receive_data)
+        receive_thread.daemon = True
+        receive_thread.start()
+    
+    def reconnect(self):
+        """Reconnect with the session token and ask only for messages we missed"""
+        if not self.connect_to_server(quiet=True):
+            self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX)
+            self.root.after(self.reconnect_delay, self.reconnect)
+            return
+        
+        self.reconnect_delay = RECONNECT_DELAY
+        self.send_data({
+            'action': 'resume',
+            'username': self.username,
+            'token': self.session_token,
+            'room': self.current_room or 'General',
+            'last_seen': {room: message_id for room, message_id in self.last_seen.items()
+                          if room == self.current_room}
+        })
+        self.start_receiving()
+    
+    def note_seen(self, room, message_id):
+        if message_id and message_id > self.last_seen.get(room, 0):
+            self.last_seen[room] = message_id
     
     def handle_server_response(self, data):
         """Handle different server responses"""
         action = data.get('action')
         
-        if action == 'register_response':
+        if action == 'connection_lost':
+            if self.session_token:
+                self.root.after(self.reconnect_delay, self.reconnect)
+        
+        elif action == 'register_response':
             if data['success']:
                 messagebox.showinfo("Success", data['message'])
             else:
@@ -123,43 +258,143 @@ class ChatClient:
         elif action == 'login_response':
             if data['success']:
                 self.rooms = data['rooms']
+                self.session_token = data.get('token')
                 self.show_chat_screen()
+                self.resume_uploads()
             else:
                 messagebox.showerror("Error", data['message'])
         
         elif action == 'room_joined':
-            self.current_room = data['room']
-            self.room_label.config(text=f"Room: {self.current_room}")
-            self.chat_display.config(state='normal')
-            self.chat_display.delete(1.0, tk.END)
-            
-            # Display history
-            for msg in data['history']:
-                self.display_message(msg[0], msg[1], msg[2], msg[3])
-            
-            self.chat_display.config(state='disabled')
-            self.update_user_list(data['users'])
+            self.show_room(data['room'], data['history'], data.get('next_before_id'),
+                           data['users'], data.get('version'))
+        
+        elif action == 'resume_response':
+            if not data['success']:
+                self.session_token = None
+                messagebox.showerror("Error", data['message'])
+                self.show_login_screen()
+                return
+            self.rooms = data['rooms']
+            room = data['room']
+            if room in data['missed'] and room == self.current_room:
+                # Same screen as before the drop: append what we missed
+                for msg in data['missed'][room]:
+                    self.display_history_row(msg)
+                    self.note_seen(room, msg[4])
+                self.update_user_list(data['users'], data['version'])
+            else:
+                self.show_room(room, data['history'], data['next_before_id'],
+                               data['users'], data['version'])
+            self.resume_uploads()
+        
+        elif action == 'user_list':
+            if data['room'] == self.current_room:
+                self.update_user_list(data['users'], data['version'])
+        
+        elif action == 'search_results':
+            self.show_search_results(data)
+        
+        elif action == 'history_page':
+            if data['room'] == self.current_room:
+                self.prepend_history(data['messages'])
+                self.history_cursor = data['next_before_id']
+            self.loading_history = False
         
         elif action == 'new_message':
+            self.note_seen(self.current_room, data.get('id'))
             self.display_message(data['username'], data['message'], 
-                               data['timestamp'], data['type'])
+                               data['timestamp'], data['type'], data.get('id'))
             self.show_notification(data['username'], data['message'])
         
         elif action == 'new_file':
-            self.display_file(data['username'], data['filename'], 
-                            data['filedata'], data['timestamp'])
-        
-        elif action == 'user_joined':
-            self.chat_display.config(state='normal')
-            self.chat_display.insert(tk.END, f"\n[{data['username']} joined the room]\n", 'system')
-            self.chat_display.config(state='disabled')
-            self.update_user_list(data['users'])
-        
-        elif action == 'user_left':
-            self.chat_display.config(state='normal')
-            self.chat_display.insert(tk.END, f"\n[{data['username']} left the room]\n", 'system')
-            self.chat_display.config(state='disabled')
-            self.update_user_list(data['users'])
+            self.note_seen(self.current_room, data.get('id'))
+            self.display_file(data['username'], data['filename'], data['timestamp'],
+                            data['file_id'], data['size'], data.get('id'))
+        
+        elif action == 'message_saved':
+            # Our own message's ID, so a resume does not replay it
+            self.note_seen(data['room'], data['id'])
+        
+        elif action == 'upload_ready':
+            upload = self.uploads.get(data['file_id'])
+            if upload:
+                with self.upload_cond:
+                    upload['acked'] = data['offset']
+                    # A worker left over from before a reconnect sees this and stops
+                    upload['generation'] = upload.get('generation', 0) + 1
+                    self.upload_cond.notify_all()
+                threading.Thread(target=self.upload_worker,
+                                 args=(data['file_id'], data['offset'], upload['generation']),
+                                 daemon=True).start()
+        
+        elif action == 'ping':
+            self.send_data({'action': 'pong'})
+        
+        elif action == 'rate_limited':
+            if data.get('file_id'):
+                # A new upload the server refused; it never started, so there is nothing to resume
+                with self.upload_cond:
+                    self.uploads.pop(data['file_id'], None)
+                    self.upload_cond.notify_all()
+            self.render([f"\n[Sending too fast: that was not delivered, try again in "
+                         f"{data['retry_after']:.1f}s]\n", 'system'])
+        
+        elif action == 'upload_ack':
+            with self.upload_cond:
+                upload = self.uploads.get(data['file_id'])
+                if upload:
+                    # Held-back acks may fire out of order
+                    upload['acked'] = max(upload['acked'], data['offset'])
+                self.upload_cond.notify_all()
+        
+        elif action == 'upload_complete':
+            with self.upload_cond:
+                upload = self.uploads.pop(data['file_id'], None)
+                self.upload_cond.notify_all()
+            self.note_seen(data.get('room', self.current_room), data.get('id'))
+            if upload:
+                # Display own file
+                self.display_file(self.username, upload['filename'],
+                                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                data['file_id'], upload['size'])
+                self.show_image(data['file_id'], upload['filename'], upload['path'])
+        
+        elif action == 'file_chunk':
+            self.receive_chunk(data)
+        
+        elif action == 'download_saved':
+            self.render([f"\n[Saved {data['filename']}]\n", 'system'])
+            self.show_image(data['file_id'], data['filename'], data['path'])
+        
+        elif action == 'thumbnail_ready':
+            self.place_preview(data['file_id'], data['image'])
+        
+        elif action == 'error':
+            messagebox.showerror("Error", data['message'])
+        
+        elif action == 'transfer_error':
+            with self.upload_cond:
+                self.uploads.pop(data['file_id'], None)
+                self.upload_cond.notify_all()
+            download = self.downloads.pop(data['file_id'], None)
+            if download:
+                download['file'].close()
+            messagebox.showerror("File Transfer", data['message'])
+        
+        elif action == 'presence':
+            if data['room'] != self.current_room or data['version'] <= self.presence_version:
+                return
+            if data['since'] > self.presence_version:
+                # Missed a delta; fetch a fresh snapshot instead of guessing
+                self.send_data({'action': 'fetch_users', 'room': self.current_room})
+                return
+            # Batched deltas may overlap the snapshot we joined with; applying them is idempotent
+            self.apply_presence(data['added'], data['removed'], data['version'])
+            joined = [user for user in data['added'] if user != self.username]
+            if joined:
+                self.render([f"\n[{', '.join(joined)} joined the room]\n", 'system'])
+            if data['removed']:
+                self.render([f"\n[{', '.join(data['removed'])} left the room]\n", 'system'])
     
     def register(self):
         """Register new user"""
@@ -199,9 +434,7 @@ class ChatClient:
         })
         
         # Start receiving thread
-        receive_thread = threading.Thread(target=self.receive_data)
-        receive_thread.daemon = True
-        receive_thread.start()
+        self.start_receiving()
     
     def show_chat_screen(self):
         """Display main chat interface"""
@@ -223,6 +456,12 @@ class ChatClient:
                              font=('Arial', 12), bg='#34495e', fg='white')
         user_label.pack(side='right', padx=15, pady=15)
         
+        self.search_entry = tk.Entry(top_bar, font=('Arial', 11), width=22)
+        self.search_entry.pack(side='right', padx=(0, 5), pady=15)
+        self.search_entry.bind('<Return>', self.search_messages)
+        tk.Label(top_bar, text="🔍", font=('Arial', 12),
+                bg='#34495e', fg='white').pack(side='right')
+        
         # Middle section
         middle_frame = tk.Frame(main_frame, bg='#2c3e50')
         middle_frame.pack(fill='both', expand=True)
@@ -250,11 +489,13 @@ class ChatClient:
             bg='#ecf0f1', fg='#2c3e50', state='disabled'
         )
         self.chat_display.pack(fill='both', expand=True, padx=5, pady=5)
+        self.chat_display.config(yscrollcommand=self.on_chat_scroll)
         
         # Configure tags
         self.chat_display.tag_config('username', foreground='#3498db', font=('Arial', 11, 'bold'))
         self.chat_display.tag_config('timestamp', foreground='#7f8c8d', font=('Arial', 9))
         self.chat_display.tag_config('system', foreground='#95a5a6', font=('Arial', 10, 'italic'))
+        self.chat_display.tag_config('link', foreground='#2980b9', underline=True)
         
         # Message input area
         input_frame = tk.Frame(center_panel, bg='#ecf0f1')
@@ -343,66 +584,354 @@ class ChatClient:
         )
         
         if filename:
-            try:
-                with open(filename, 'rb') as f:
-                    filedata = base64.b64encode(f.read()).decode()
-                
-                basename = os.path.basename(filename)
-                
-                self.send_data({
-                    'action': 'send_file',
-                    'room': self.current_room,
-                    'filename': basename,
-                    'filedata': filedata
-                })
-                
-                # Display own file
-                self.display_file(self.username, basename, filedata,
-                                datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to send file: {e}")
+            threading.Thread(target=self.prepare_upload, args=(filename, self.current_room),
+                             daemon=True).start()
     
-    def display_message(self, username, message, timestamp, msg_type):
-        """Display message in chat"""
-        self.chat_display.config(state='normal')
+    def prepare_upload(self, filename, room):
+        """Register an upload off the UI thread and ask the server where to start"""
+        try:
+            file_id = uuid.uuid4().hex
+            with self.upload_cond:
+                self.uploads[file_id] = {
+                    'path': filename,
+                    'filename': os.path.basename(filename),
+                    'size': os.path.getsize(filename),
+                    'room': room,
+                    'acked': 0
+                }
+            self.start_upload(file_id)
+        except Exception as e:
+            # Widgets belong to the Tk thread; report it like a server-side transfer error
+            self.inbound.put({'action': 'transfer_error', 'file_id': None,
+                              'message': f"Failed to send file: {e}"})
+    
+    def start_upload(self, file_id):
+        """Ask the server where to start; it answers with upload_ready"""
+        upload = self.uploads[file_id]
+        self.send_data({
+            'action': 'upload_start',
+            'file_id': file_id,
+            'room': upload['room'],
+            'filename': upload['filename'],
+            'size': upload['size']
+        })
+    
+    def resume_uploads(self):
+        """Continue uploads interrupted by a lost connection"""
+        with self.upload_cond:
+            pending = list(self.uploads)
+        for file_id in pending:
+            self.start_upload(file_id)
+    
+    def upload_worker(self, file_id, offset, generation):
+        """Stream a file in chunks, keeping at most a window of unacknowledged bytes in flight"""
+        upload = self.uploads.get(file_id)
+        window = transfer.WINDOW_CHUNKS * transfer.CHUNK_SIZE
+        try:
+            with open(upload['path'], 'rb') as f:
+                f.seek(offset)
+                while offset < upload['size']:
+                    with self.upload_cond:
+                        # No timeout: the server holds acks back while it paces the upload
+                        self.upload_cond.wait_for(
+                            lambda: (file_id not in self.uploads or upload['generation'] != generation
+                                     or offset - upload['acked'] < window))
+                    if file_id not in self.uploads or upload['generation'] != generation:
+                        return
+                    
+                    chunk = f.read(transfer.CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    self.send_data({
+                        'action': 'upload_chunk',
+                        'file_id': file_id,
+                        'offset': offset,
+                        'chunk': chunk
+                    })
+                    offset += len(chunk)
+        except OSError as e:
+            # Left in self.uploads so the next login resumes it
+            print(f"Upload of {upload['filename']} interrupted: {e}")
+    
+    def download_file(self, file_id, filename, size):
+        """Fetch an announced file on demand"""
+        path = filedialog.asksaveasfilename(title="Save file", initialfile=filename)
+        if not path or file_id in self.downloads:
+            return
         
-        # Timestamp
-        self.chat_display.insert(tk.END, f"\n{timestamp} ", 'timestamp')
+        download = {'path': path, 'filename': filename, 'size': size, 'offset': 0,
+                    'resyncing': False, 'file': open(path, 'wb')}
+        self.downloads[file_id] = download
+        if size == 0:
+            self.finish_download(file_id)
+            return
+        self.send_data({'action': 'download_file', 'file_id': file_id, 'offset': 0})
+    
+    def receive_chunk(self, data):
+        """Write a downloaded chunk and acknowledge it"""
+        file_id = data['file_id']
+        download = self.downloads.get(file_id)
+        if not download:
+            return
         
-        # Username
-        self.chat_display.insert(tk.END, f"{username}: ", 'username')
+        if data['offset'] != download['offset']:
+            # A chunk went missing: resume from the last byte we have
+            if not download['resyncing']:
+                download['resyncing'] = True
+                self.send_data({'action': 'download_file', 'file_id': file_id,
+                                'offset': download['offset']})
+            return
         
-        # Message
-        self.chat_display.insert(tk.END, f"{message}\n")
+        download['resyncing'] = False
+        download['file'].write(data['chunk'])
+        download['offset'] += len(data['chunk'])
+        self.send_data({'action': 'download_ack', 'file_id': file_id, 'offset': download['offset']})
         
-        self.chat_display.see(tk.END)
+        if download['offset'] >= download['size']:
+            self.finish_download(file_id)
+    
+    def finish_download(self, file_id):
+        download = self.downloads.pop(file_id)
+        download['file'].close()
+        self.inbound.put({'action': 'download_saved', 'file_id': file_id,
+                          'filename': download['filename'], 'path': download['path']})
+    
+    def search_messages(self, event=None, before_id=None, query=None):
+        """Search the current room's messages"""
+        query = query or self.search_entry.get().strip()
+        if not query or not self.current_room:
+            return
+        request = {'action': 'search_messages', 'query': query, 'room': self.current_room}
+        if before_id:
+            request['before_id'] = before_id
+        self.send_data(request)
+    
+    def show_search_results(self, data):
+        """List search hits in their own window with the matched words highlighted"""
+        if not data['before_id'] or not self.search_window or not self.search_window.winfo_exists():
+            if self.search_window and self.search_window.winfo_exists():
+                self.search_window.destroy()
+            self.search_window = tk.Toplevel(self.root)
+            self.search_window.title(f"Search: {data['query']}")
+            self.search_window.geometry("520x420")
+            self.search_results = scrolledtext.ScrolledText(self.search_window, wrap=tk.WORD,
+                                                            font=('Arial', 10), state='disabled')
+            self.search_results.pack(fill='both', expand=True, padx=5, pady=5)
+            self.search_results.tag_config('match', background='#f9e79f')
+            self.search_results.tag_config('timestamp', foreground='#7f8c8d', font=('Arial', 9))
+            self.search_more = tk.Button(self.search_window, text="More results")
+            if not data['results']:
+                self.search_results.config(state='normal')
+                self.search_results.insert(tk.END, "No messages found.")
+                self.search_results.config(state='disabled')
+        
+        results = self.search_results
+        results.config(state='normal')
+        for hit in data['results']:
+            results.insert(tk.END, f"[{hit['timestamp']}] ", 'timestamp')
+            results.insert(tk.END, f"{hit['username']}: ")
+            # The snippet brackets each match with control characters
+            for i, part in enumerate(hit['snippet'].replace('\x03', '\x02').split('\x02')):
+                results.insert(tk.END, part, 'match' if i % 2 else ())
+            results.insert(tk.END, "\n\n")
+        results.config(state='disabled')
+        
+        if data['next_before_id']:
+            self.search_more.config(command=lambda: self.search_messages(before_id=data['next_before_id'],
+                                                                        query=data['query']))
+            self.search_more.pack(pady=(0, 5))
+        else:
+            self.search_more.pack_forget()
+    
+    def show_room(self, room, history, next_before_id, users, version):
+        """Redraw the chat for a room from its newest history page"""
+        self.current_room = room
+        self.room_label.config(text=f"Room: {self.current_room}")
+        self.chat_display.config(state='normal')
+        self.chat_display.delete(1.0, tk.END)
         self.chat_display.config(state='disabled')
+        self.file_marks.clear()
+        self.previews.clear()
+        self.rendered.clear()
+        # Anything queued for the previous room must not land in this one
+        self.render_chunks, self.render_after = [], []
+        
+        # Display history
+        for msg in history:
+            self.display_history_row(msg)
+            self.note_seen(room, msg[4] if len(msg) > 4 else None)
+        
+        self.flush_render()
+        self.history_cursor = next_before_id
+        self.loading_history = False
+        self.update_user_list(users, version)
+    
+    def display_history_row(self, msg):
+        """Show one (username, message, timestamp, type, id, file) history row"""
+        message_id = msg[4] if len(msg) > 4 else None
+        if len(msg) > 5 and msg[5]:
+            self.display_file(msg[0], msg[5]['filename'], msg[2],
+                            msg[5]['file_id'], msg[5]['size'], message_id)
+        else:
+            self.display_message(msg[0], msg[1], msg[2], msg[3], message_id)
+    
+    def display_message(self, username, message, timestamp, msg_type, message_id=None):
+        """Display message in chat"""
+        self.render([
+            f"\n{timestamp} ", 'timestamp',
+            f"{username}: ", 'username',
+            f"{message}\n", ()
+        ], message_id)
+    
+    def render(self, chunks, message_id=None, file_id=None, after=None):
+        """Queue one chat entry as (text, tags, ...) chunks for the next batched insert"""
+        self.render_chunks += chunks
+        self.rendered.append([message_id, sum(text.count('\n') for text in chunks[::2]), file_id])
+        if after:
+            self.render_after.append(after)
+        if not self.rendering:
+            self.flush_render()
     
-    def display_file(self, username, filename, filedata, timestamp):
-        """Display file in chat"""
+    def flush_render(self):
+        """Insert everything queued in one call, trim old lines and scroll once"""
+        if not self.render_chunks:
+            return
         self.chat_display.config(state='normal')
+        self.chat_display.insert(tk.END, *self.render_chunks)
+        for callback in self.render_after:
+            callback()
+        self.render_chunks, self.render_after = [], []
+        self.trim_chat()
+        self.chat_display.config(state='disabled')
+        self.chat_display.see(tk.END)
+    
+    def trim_chat(self):
+        """Drop whole entries from the top once the chat exceeds MAX_RENDERED_LINES"""
+        excess = int(self.chat_display.index('end-1c').split('.')[0]) - MAX_RENDERED_LINES
+        if excess <= 0:
+            return
+        removed = 0
+        while len(self.rendered) > 1 and removed < excess:
+            _, lines, file_id = self.rendered.popleft()
+            removed += lines
+            if file_id:
+                self.previews.pop(file_id, None)
+                if self.file_marks.pop(file_id, None):
+                    self.chat_display.mark_unset(f"file-{file_id}")
+                self.chat_display.tag_delete(f"file-{file_id}")
+        self.chat_display.delete('1.0', f'{removed + 1}.0')
+        
+        # Scrolling back now reloads from the oldest entry still shown
+        for message_id, _, _ in self.rendered:
+            if message_id:
+                self.history_cursor = message_id
+                break
+    
+    def on_chat_scroll(self, first, last):
+        """Keep the scrollbar in sync and fetch older messages at the top"""
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0:
+            self.load_older_messages()
+    
+    def load_older_messages(self):
+        """Request the page of history before the oldest displayed message"""
+        if self.loading_history or not self.history_cursor or not self.current_room:
+            return
         
-        self.chat_display.insert(tk.END, f"\n{timestamp} ", 'timestamp')
-        self.chat_display.insert(tk.END, f"{username}: ", 'username')
-        self.chat_display.insert(tk.END, f"📎 {filename}\n")
+        self.loading_history = True
+        self.send_data({
+            'action': 'fetch_history',
+            'room': self.current_room,
+            'before_id': self.history_cursor,
+            'limit': 50
+        })
+    
+    def prepend_history(self, messages):
+        """Insert an older page above the current chat without moving the view"""
+        if not messages:
+            return
         
-        # Try to display image
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')):
-            try:
-                image_data = base64.b64decode(filedata)
-                image = Image.open(io.BytesIO(image_data))
-                image.thumbnail((300, 300))
-                photo = ImageTk.PhotoImage(image)
-                
-                self.chat_display.image_create(tk.END, image=photo)
-                self.chat_display.image = photo  # Keep reference
-                self.chat_display.insert(tk.END, "\n")
-            except:
-                pass
+        chunks = []
+        links = []
+        for msg in messages:
+            chunks += [f"\n{msg[2]} ", 'timestamp', f"{msg[0]}: ", 'username']
+            if len(msg) > 5 and msg[5]:
+                file = msg[5]
+                tag = f"file-{file['file_id']}"
+                chunks += [f"📎 {file['filename']}", ('link', tag),
+                           f" ({self.format_size(file['size'])})\n", ()]
+                links.append((tag, file))
+            else:
+                chunks += [f"{msg[1]}\n", ()]
+        for msg in reversed(messages):
+            file_id = msg[5]['file_id'] if len(msg) > 5 and msg[5] else None
+            lines = 2 if file_id else 2 + msg[1].count('\n')
+            self.rendered.appendleft([msg[4], lines, file_id])
         
-        self.chat_display.see(tk.END)
+        lines_before = int(self.chat_display.index('end-1c').split('.')[0])
+        self.chat_display.config(state='normal')
+        self.chat_display.insert('1.0', *chunks)
         self.chat_display.config(state='disabled')
+        for tag, file in links:
+            self.chat_display.tag_bind(tag, '<Button-1>', lambda e, f=file: self.download_file(
+                f['file_id'], f['filename'], f['size']))
+        
+        # Keep the previously top line at the top of the view
+        added = int(self.chat_display.index('end-1c').split('.')[0]) - lines_before
+        self.chat_display.yview(f"{added + 1}.0")
+    
+    def display_file(self, username, filename, timestamp, file_id=None, size=None, message_id=None):
+        """Display file announcement in chat"""
+        chunks = [f"\n{timestamp} ", 'timestamp', f"{username}: ", 'username']
+        
+        if not file_id:
+            self.render(chunks + [f"📎 {filename}\n", ()], message_id)
+            return
+        
+        # Content is only fetched when the link is clicked
+        tag = f"file-{file_id}"
+        
+        def link():
+            self.chat_display.tag_bind(tag, '<Button-1>',
+                                       lambda e: self.download_file(file_id, filename, size))
+            # Where a preview goes once the content is available
+            self.chat_display.mark_set(tag, f"{self.chat_display.tag_ranges(tag)[-1]} +1 lines linestart")
+            self.chat_display.mark_gravity(tag, 'left')
+            self.file_marks[file_id] = tag
+        
+        self.render(chunks + [f"📎 {filename}", ('link', tag),
+                              f" ({self.format_size(size)})\n", ()],
+                    message_id, file_id, link)
+    
+    def show_image(self, file_id, filename, path, digest=None):
+        """Decode a thumbnail of a local image in the background; place_preview shows it"""
+        if file_id in self.file_marks and filename.lower().endswith(thumbnails.IMAGE_EXTENSIONS):
+            self.thumbnails.submit(file_id, path, digest)
+    
+    def place_preview(self, file_id, image):
+        """Show a decoded thumbnail under its file announcement"""
+        mark = self.file_marks.get(file_id)
+        if not mark or file_id in self.previews:
+            return
+        
+        photo = ImageTk.PhotoImage(image)
+        self.chat_display.config(state='normal')
+        self.chat_display.image_create(mark, image=photo)
+        self.chat_display.insert(f"{mark}+1c", "\n")
+        self.chat_display.config(state='disabled')
+        self.previews[file_id] = photo
+        for entry in self.rendered:
+            if entry[2] == file_id:
+                entry[1] += 1  # the preview's line goes when the entry is trimmed
+                break
+    
+    def format_size(self, size):
+        """Human readable file size"""
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return f"{size:.0f} {unit}"
+            size /= 1024
+        return f"{size:.1f} GB"
     
     def show_emoji_picker(self):
         """Show emoji picker window"""
@@ -429,11 +958,26 @@ class ChatClient:
         self.message_entry.insert(tk.INSERT, emoji)
         window.destroy()
     
-    def update_user_list(self, users):
-        """Update online users list"""
+    def update_user_list(self, users, version=None):
+        """Replace the online users list with a full snapshot"""
+        self.room_users = sorted(users)
+        self.presence_version = version or 0
         self.user_listbox.delete(0, tk.END)
-        for user in users:
-            self.user_listbox.insert(tk.END, f"👤 {user}")
+        self.user_listbox.insert(tk.END, *(f"👤 {user}" for user in self.room_users))
+    
+    def apply_presence(self, added, removed, version):
+        """Patch the users list in place from a presence delta"""
+        for user in removed:
+            index = bisect.bisect_left(self.room_users, user)
+            if index < len(self.room_users) and self.room_users[index] == user:
+                del self.room_users[index]
+                self.user_listbox.delete(index)
+        for user in added:
+            index = bisect.bisect_left(self.room_users, user)
+            if index == len(self.room_users) or self.room_users[index] != user:
+                self.room_users.insert(index, user)
+                self.user_listbox.insert(index, f"👤 {user}")
+        self.presence_version = version
     
     def show_notification(self, username, message):
         """Show notification for new message"""
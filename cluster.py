@@ -0,0 +1,174 @@
+# cluster.py
+# Multi-process mode: worker processes share the listening port through
+# SO_REUSEPORT, so the kernel spreads connections across them, and a local
+# pub/sub bus relays room traffic between workers.
+import os
+import socket
+import signal
+import sys
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import protocol
+import outbound
+import persistence
+import schema
+
+BUS_QUEUE_SIZE = 65536
+
+
+class Broker:
+    """Relays every frame a worker publishes to all the other workers.
+
+    Runs in the parent process on a Unix socket. Each worker gets a queued
+    writer, so one slow worker only grows its own queue.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.lock = threading.Lock()
+        self.peers = []  # QueuedSocketWriter per worker
+        self.stats = {'frames': 0, 'bytes': 0}
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            writer = outbound.QueuedSocketWriter(sock, BUS_QUEUE_SIZE)
+            with self.lock:
+                self.peers.append(writer)
+            threading.Thread(target=self.relay, args=(sock, writer), daemon=True).start()
+
+    def relay(self, sock, writer):
+        reader = protocol.FrameReader(sock, protocol.MAX_FRAME_SIZE)
+        try:
+            while True:
+                payload = reader.read_frame()
+                if payload is None:
+                    break
+                frame = protocol.encode_frame(payload)
+                with self.lock:
+                    self.stats['frames'] += 1
+                    self.stats['bytes'] += len(frame)
+                    peers = [peer for peer in self.peers if peer is not writer]
+                for peer in peers:
+                    peer.send_frame(frame)
+        except (OSError, protocol.FrameError):
+            pass
+        finally:
+            with self.lock:
+                self.peers.remove(writer)
+            writer.close()
+            sock.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class Bus:
+    """A worker's connection to the broker.
+
+    publish() never blocks the caller; events from other workers are handed
+    to deliver() on the bus reader thread.
+    """
+
+    def __init__(self, path, worker_id, deliver):
+        self.worker_id = worker_id
+        self.deliver = deliver
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.writer = outbound.QueuedSocketWriter(self.sock, BUS_QUEUE_SIZE)
+        self.received = 0
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def publish(self, event):
+        event['worker'] = self.worker_id
+        self.writer.send_frame(protocol.encode_frame(protocol.encode_body(event)))
+
+    def read_loop(self):
+        reader = protocol.FrameReader(self.sock, protocol.MAX_FRAME_SIZE)
+        try:
+            while True:
+                payload = reader.read_frame()
+                if payload is None:
+                    break
+                self.received += 1
+                self.deliver(protocol.decode_body(payload))
+        except (OSError, protocol.FrameError):
+            pass
+
+    def get_stats(self):
+        stats = self.writer.stats()
+        return {'published': stats['enqueued'], 'dropped': stats['dropped'],
+                'depth': stats['depth'], 'received': self.received}
+
+    def close(self):
+        self.writer.close()
+        self.sock.close()
+
+
+def stop_on_sigterm():
+    # Unwind through the server's finally block so pending messages are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def run_worker(engine, options):
+    # Ctrl+C reaches the whole process group; let the parent decide when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop_on_sigterm()
+    if engine == 'asyncio':
+        from async_server import AsyncChatServer as Server
+    else:
+        from server import ChatServer as Server
+    server = Server(**options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def run(engine, options, workers):
+    """Start a broker and `workers` server processes, and wait for them"""
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("Multiple workers need SO_REUSEPORT and Unix sockets")
+
+    # Migrate once here so workers never race on the schema
+    conn = persistence.connect(options['db_path'])
+    schema.migrate(conn)
+    conn.close()
+
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    bus_path = os.path.join(bus_dir, 'bus.sock')
+    broker = Broker(bus_path)
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for worker_id in range(workers):
+        worker_options = dict(options, worker_id=worker_id, workers=workers,
+                              reuse_port=True, bus_path=bus_path)
+        process = context.Process(target=run_worker, args=(engine, worker_options),
+                                  name=f'chat-worker-{worker_id}')
+        process.start()
+        processes.append(process)
+    print(f"Started {workers} {engine} workers on {options['host']}:{options['port']}")
+
+    stop_on_sigterm()
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    finally:
+        broker.close()
+        shutil.rmtree(bus_dir, ignore_errors=True)
@@ -0,0 +1,398 @@
+# codec.py
+# Wire formats: a serializer (how a message dict becomes bytes) paired with a
+# cipher (how those bytes are protected), optionally with a compressor in
+# between. Clients negotiate one with a 'hello'.
+import os
+import struct
+import base64
+import threading
+import time
+import zlib
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import protocol
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+COMPRESS_THRESHOLD = 512  # smaller bodies gain little and cost a compressor setup
+COMPRESS_LEVEL = 6
+
+
+class CodecError(Exception):
+    """Raised when a payload cannot be decoded"""
+
+
+class JsonCodec:
+    """The original format: JSON, with raw file chunks appended after a NUL"""
+
+    name = 'json'
+
+    def encode(self, message):
+        return protocol.encode_body(message)
+
+    def decode(self, data):
+        return protocol.decode_body(data)
+
+
+class BinaryCodec:
+    """MessagePack: compact, and bytes fields such as file chunks travel raw.
+
+    Uses the msgpack C extension when it is installed and the pure Python
+    packer below otherwise; both produce the same bytes.
+    """
+
+    name = 'binary'
+
+    def encode(self, message):
+        if msgpack is not None:
+            return msgpack.packb(message, use_bin_type=True)
+        out = bytearray()
+        pack(message, out)
+        return bytes(out)
+
+    def decode(self, data):
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False)
+        value, end = unpack(data, 0)
+        if end != len(data):
+            raise CodecError("Trailing bytes after message")
+        return value
+
+
+def pack(value, out):
+    """Append the MessagePack encoding of value to out"""
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xff)
+        elif value > 0:
+            if value < 0x100:
+                out += struct.pack('>BB', 0xcc, value)
+            elif value < 0x10000:
+                out += struct.pack('>BH', 0xcd, value)
+            elif value < 0x100000000:
+                out += struct.pack('>BI', 0xce, value)
+            else:
+                out += struct.pack('>BQ', 0xcf, value)
+        elif value >= -0x80:
+            out += struct.pack('>Bb', 0xd0, value)
+        elif value >= -0x8000:
+            out += struct.pack('>Bh', 0xd1, value)
+        elif value >= -0x80000000:
+            out += struct.pack('>Bi', 0xd2, value)
+        else:
+            out += struct.pack('>Bq', 0xd3, value)
+    elif isinstance(value, float):
+        out += struct.pack('>Bd', 0xcb, value)
+    elif isinstance(value, str):
+        data = value.encode()
+        size = len(data)
+        if size < 32:
+            out.append(0xa0 | size)
+        elif size < 0x100:
+            out += struct.pack('>BB', 0xd9, size)
+        elif size < 0x10000:
+            out += struct.pack('>BH', 0xda, size)
+        else:
+            out += struct.pack('>BI', 0xdb, size)
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        size = len(value)
+        if size < 0x100:
+            out += struct.pack('>BB', 0xc4, size)
+        elif size < 0x10000:
+            out += struct.pack('>BH', 0xc5, size)
+        else:
+            out += struct.pack('>BI', 0xc6, size)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        size = len(value)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size < 0x10000:
+            out += struct.pack('>BH', 0xdc, size)
+        else:
+            out += struct.pack('>BI', 0xdd, size)
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        size = len(value)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size < 0x10000:
+            out += struct.pack('>BH', 0xde, size)
+        else:
+            out += struct.pack('>BI', 0xdf, size)
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+# Fixed-size MessagePack headers: {type byte: (struct format, kind)}
+HEADERS = {
+    0xc4: ('>B', 'bin'), 0xc5: ('>H', 'bin'), 0xc6: ('>I', 'bin'),
+    0xca: ('>f', 'value'), 0xcb: ('>d', 'value'),
+    0xcc: ('>B', 'value'), 0xcd: ('>H', 'value'), 0xce: ('>I', 'value'), 0xcf: ('>Q', 'value'),
+    0xd0: ('>b', 'value'), 0xd1: ('>h', 'value'), 0xd2: ('>i', 'value'), 0xd3: ('>q', 'value'),
+    0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+    0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'),
+    0xde: ('>H', 'map'), 0xdf: ('>I', 'map'),
+}
+
+
+def unpack(data, pos):
+    """Decode one MessagePack value at pos; returns (value, next position)"""
+    try:
+        byte = data[pos]
+    except IndexError:
+        raise CodecError("Truncated message")
+    pos += 1
+
+    if byte < 0x80:
+        return byte, pos
+    if byte >= 0xe0:
+        return byte - 0x100, pos
+    if 0xa0 <= byte <= 0xbf:
+        kind, size = 'str', byte & 0x1f
+    elif 0x90 <= byte <= 0x9f:
+        kind, size = 'array', byte & 0x0f
+    elif 0x80 <= byte <= 0x8f:
+        kind, size = 'map', byte & 0x0f
+    elif byte == 0xc0:
+        return None, pos
+    elif byte == 0xc2:
+        return False, pos
+    elif byte == 0xc3:
+        return True, pos
+    elif byte in HEADERS:
+        fmt, kind = HEADERS[byte]
+        end = pos + struct.calcsize(fmt)
+        if end > len(data):
+            raise CodecError("Truncated message")
+        (size,) = struct.unpack(fmt, data[pos:end])
+        pos = end
+        if kind == 'value':
+            return size, pos
+    else:
+        raise CodecError(f"Unsupported type byte 0x{byte:02x}")
+
+    if kind in ('str', 'bin'):
+        end = pos + size
+        if end > len(data):
+            raise CodecError("Truncated message")
+        chunk = data[pos:end]
+        return (chunk.decode() if kind == 'str' else bytes(chunk)), end
+    if kind == 'array':
+        items = []
+        for _ in range(size):
+            item, pos = unpack(data, pos)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(size):
+        key, pos = unpack(data, pos)
+        result[key], pos = unpack(data, pos)
+    return result, pos
+
+
+class FernetCipher:
+    """AES-CBC + HMAC-SHA256 with a timestamp, base64 encoded (~1.4x inflation)"""
+
+    name = 'fernet'
+
+    def __init__(self, key):
+        self.key = key
+        self.fernet = Fernet(key)
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(data)
+
+    def decrypt(self, data):
+        return self.fernet.decrypt(data)
+
+
+class AesGcmCipher:
+    """AES-256-GCM: one AEAD pass, raw bytes, 28 bytes of overhead per frame"""
+
+    name = 'aesgcm'
+    NONCE_SIZE = 12
+
+    def __init__(self, key=None):
+        self.key = key or AESGCM.generate_key(bit_length=256)
+        self.aead = AESGCM(self.key)
+
+    def encrypt(self, data):
+        nonce = os.urandom(self.NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, data, None)
+
+    def decrypt(self, data):
+        data = bytes(data)
+        return self.aead.decrypt(data[:self.NONCE_SIZE], data[self.NONCE_SIZE:], None)
+
+
+class ZlibCompressor:
+    """Deflate for frame bodies above a size threshold.
+
+    Every body gets a one byte flag, so small frames (including the ones that
+    carry tokens and keys) go out untouched and a body that does not shrink
+    is sent as it was. Counters are shared by every connection using the
+    same wire format.
+    """
+
+    name = 'zlib'
+    dictionary = None
+    RAW = b'\x00'
+    DEFLATED = b'\x01'
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL, max_size=protocol.MAX_FRAME_SIZE):
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size  # largest body a deflated frame may inflate to
+        self.lock = threading.Lock()
+        self.stats = {'frames': 0, 'compressed': 0, 'bytes_in': 0, 'bytes_out': 0,
+                      'compress_seconds': 0.0, 'decompressed': 0, 'decompress_seconds': 0.0}
+
+    def compress(self, body):
+        if len(body) < self.threshold:
+            with self.lock:
+                self.stats['frames'] += 1
+            return self.RAW + body
+        started = time.thread_time()
+        compressor = (zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary
+                      else zlib.compressobj(self.level))
+        packed = compressor.compress(body) + compressor.flush()
+        elapsed = time.thread_time() - started
+        shrunk = len(packed) < len(body)
+        with self.lock:
+            self.stats['frames'] += 1
+            self.stats['compress_seconds'] += elapsed
+            if shrunk:
+                self.stats['compressed'] += 1
+                self.stats['bytes_in'] += len(body)
+                self.stats['bytes_out'] += len(packed)
+        return self.DEFLATED + packed if shrunk else self.RAW + body
+
+    def decompress(self, data):
+        flag, body = data[:1], data[1:]
+        if flag == self.RAW:
+            return body
+        if flag != self.DEFLATED:
+            raise CodecError("Unknown compression flag")
+        started = time.thread_time()
+        decompressor = (zlib.decompressobj(zdict=self.dictionary) if self.dictionary
+                        else zlib.decompressobj())
+        try:
+            # Bounded like a frame, so a small body cannot inflate without limit
+            inflated = decompressor.decompress(body, self.max_size)
+        except zlib.error as e:
+            raise CodecError(f"Corrupt compressed body: {e}")
+        if decompressor.unconsumed_tail:
+            raise CodecError("Decompressed body exceeds the frame size limit")
+        with self.lock:
+            self.stats['decompressed'] += 1
+            self.stats['decompress_seconds'] += time.thread_time() - started
+        return inflated
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['ratio'] = stats['bytes_in'] / stats['bytes_out'] if stats['bytes_out'] else 1.0
+        return stats
+
+
+# Typical frames in both serializations; deflate finds their keys and values
+# in the dictionary even in a message too short to repeat them. The most
+# frequent frames go last, closest to the data.
+DICTIONARY_SAMPLES = [
+    {'action': 'search_results', 'query': '', 'before_id': None, 'results': [
+        {'id': 1, 'room': 'General', 'username': '', 'timestamp': '2025-01-01 00:00:00',
+         'type': 'text', 'snippet': ''}], 'next_before_id': None},
+    {'action': 'resume_response', 'success': True, 'rooms': ['General', 'Random', 'Tech'],
+     'room': 'General', 'missed': {}, 'gaps': [], 'users': [], 'version': 0},
+    {'action': 'history_page', 'room': 'General', 'messages': [], 'next_before_id': None},
+    {'action': 'room_joined', 'room': 'General',
+     'history': [('', '', '2025-01-01 00:00:00', 'text', 1, None),
+                 ('', '[FILE:]', '2025-01-01 00:00:00', 'file', 1,
+                  {'file_id': '', 'filename': '', 'size': 0})],
+     'next_before_id': None, 'users': [], 'version': 0},
+    {'action': 'user_list', 'room': 'General', 'users': [], 'version': 0},
+    {'action': 'presence', 'room': 'General', 'added': [], 'removed': [], 'since': 0, 'version': 0},
+    {'action': 'new_file', 'id': 1, 'username': '', 'filename': '', 'file_id': '', 'size': 0,
+     'timestamp': '2025-01-01 00:00:00'},
+    {'action': 'new_message', 'id': 1, 'username': '', 'message': '', 'type': 'text',
+     'timestamp': '2025-01-01 00:00:00'},
+]
+
+
+class ChatZlibCompressor(ZlibCompressor):
+    """zlib primed with a dictionary of chat frames; the version is in the name"""
+
+    name = 'zlib-chat1'
+    dictionary = b''.join(JsonCodec().encode(sample) + BinaryCodec().encode(sample)
+                          for sample in DICTIONARY_SAMPLES)
+
+
+CODECS = {'binary': BinaryCodec, 'json': JsonCodec}
+COMPRESSORS = {'zlib-chat1': ChatZlibCompressor, 'zlib': ZlibCompressor}
+CIPHERS = ('aesgcm', 'fernet')
+# The pure Python packer loses to the C json module, so only lead with binary when msgpack is present
+PREFERRED_CODECS = ('binary', 'json') if msgpack is not None else ('json', 'binary')
+
+
+class WireFormat:
+    """A serializer and a cipher applied together to every frame body.
+
+    A compressor, when negotiated, runs between the two: encrypted bytes do
+    not compress.
+    """
+
+    def __init__(self, codec, cipher, compressor=None):
+        self.codec = codec
+        self.cipher = cipher
+        self.compressor = compressor
+        self.name = f"{codec.name}+{cipher.name}" + (f"+{compressor.name}" if compressor else '')
+
+    def encode(self, message):
+        body = self.codec.encode(message)
+        if self.compressor:
+            if 'chunk' in message:
+                # File content is usually compressed already; don't spend CPU finding out
+                body = self.compressor.RAW + body
+            else:
+                body = self.compressor.compress(body)
+        return self.cipher.encrypt(body)
+
+    def decode(self, data):
+        body = self.cipher.decrypt(data)
+        if self.compressor:
+            body = self.compressor.decompress(body)
+        return self.codec.decode(body)
+
+
+def choose(offered, supported):
+    """First of the peer's preferences that we support, or None"""
+    for name in offered or ():
+        if name in supported:
+            return name
+    return None
+
+
+def encode_key(key):
+    return base64.b64encode(key).decode()
+
+
+def decode_key(text):
+    return base64.b64decode(text)
@@ -0,0 +1,101 @@
+# history.py
+import threading
+import bisect
+from collections import deque
+
+
+class HistoryCache:
+    """Ring buffer of the most recent messages in each room.
+
+    Rooms are warmed from the database at startup, so a room missing from the
+    cache has no stored history unless it is marked partial: its oldest
+    messages were moved to the archive. A request is served from memory when
+    the buffer holds at least `limit` matching rows or the room's whole history.
+    """
+
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.rooms = {}  # {room: deque of (id, username, message, timestamp, message_type, file_id)}
+        self.lock = threading.Lock()
+        self.partial = set()  # rooms with older messages in the archive
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def load(self, rows):
+        """Warm the cache from (room, id, username, message, timestamp, message_type, file_id) rows, oldest first"""
+        with self.lock:
+            for room, *row in rows:
+                self.buffer(room).append(tuple(row))
+
+    def mark_partial(self, room):
+        """Record that some of a room's history is no longer in the messages table"""
+        with self.lock:
+            self.partial.add(room)
+
+    def complete(self, room, buffered):
+        # Until a room overflows, its buffer holds its entire history, unless part was archived
+        return len(buffered) < self.capacity and room not in self.partial
+
+    def append(self, room, row):
+        """Record a new message, evicting the oldest one when the room is full"""
+        with self.lock:
+            buffered = self.buffer(room)
+            if not buffered or row[0] > buffered[-1][0]:
+                buffered.append(row)
+                return
+            # Another worker's message can arrive after a newer local one; keep ID order
+            rows = list(buffered)
+            bisect.insort(rows, row, key=lambda entry: entry[0])
+            buffered.clear()
+            buffered.extend(rows[-self.capacity:])
+
+    def discard(self, room, message_id):
+        """Forget a message that turned out not to be stored"""
+        with self.lock:
+            buffered = self.rooms.get(room)
+            if buffered:
+                rows = [row for row in buffered if row[0] != message_id]
+                if len(rows) < len(buffered):
+                    if len(buffered) == self.capacity:
+                        # No longer full, but older messages are still only in the database
+                        self.partial.add(room)
+                    buffered.clear()
+                    buffered.extend(rows)
+
+    def recent(self, room, limit, before_id=None):
+        """Return up to `limit` newest rows older than before_id, oldest first, or None on a miss"""
+        with self.lock:
+            buffered = self.rooms.get(room, ())
+            rows = list(buffered)
+            if before_id is not None:
+                rows = rows[:bisect.bisect_left([row[0] for row in rows], before_id)]
+            if limit <= len(rows) or self.complete(room, buffered):
+                self.stats['hits'] += 1
+                return rows[-limit:] if limit else []
+            self.stats['misses'] += 1
+            return None
+
+    def since(self, room, after_id, limit):
+        """Return up to `limit` rows newer than after_id, oldest first, or None on a miss"""
+        with self.lock:
+            buffered = self.rooms.get(room, ())
+            # Complete if the buffer reaches back to after_id or still holds the whole room
+            if self.complete(room, buffered) or (buffered and buffered[0][0] <= after_id):
+                self.stats['hits'] += 1
+                rows = list(buffered)
+                start = bisect.bisect_right([row[0] for row in rows], after_id)
+                return rows[start:start + limit]
+            self.stats['misses'] += 1
+            return None
+    
+    def buffer(self, room):
+        if room not in self.rooms:
+            self.rooms[room] = deque(maxlen=self.capacity)
+        return self.rooms[room]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, rooms=len(self.rooms),
+                         messages=sum(len(rows) for rows in self.rooms.values()))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,162 @@
+# metrics.py
+import bisect
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Seconds; handlers are expected to finish well under a millisecond
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Histograms for the server's hot paths, in Prometheus text format.
+
+    Recording costs one lock and a bisect. Counters and gauges (connected
+    clients, room sizes, the components' own stats) are read from collectors
+    only when the metrics are scraped. Labels are tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = {}  # {name: (type, help)}
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.collectors = []  # callables returning [(name, type, help, [(labels, value)])]
+
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        families = {}  # {name: [lines]}
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                families.setdefault(name, []).extend(histogram.render(name, labels))
+        descriptions = dict(self.descriptions)
+        for collector in self.collectors:
+            for name, kind, help_text, samples in collector():
+                descriptions.setdefault(name, (kind, help_text))
+                families.setdefault(name, []).extend(
+                    f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+
+        lines = []
+        for name, samples in families.items():
+            kind, help_text = descriptions.get(name, ('untyped', ''))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval while a profile is requested.
+
+    Output is one "outer;inner;leaf count" line per distinct stack, the
+    collapsed format flame graph tools read. Nothing runs between profiles.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()  # one profile at a time
+
+    def profile(self, seconds):
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with self.lock:
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    calls = [f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})"
+                             for entry in traceback.extract_stack(frame)]
+                    stacks[';'.join([names.get(ident, str(ident))] + calls)] += 1
+                time.sleep(self.interval)
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class MetricsServer:
+    """Local HTTP endpoint: GET /metrics for Prometheus, GET /profile?seconds=N for stacks"""
+
+    def __init__(self, host, port, metrics, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler or SamplingProfiler()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    body = endpoint.metrics.render()
+                elif url.path == '/profile':
+                    seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+                    body = endpoint.profiler.profile(seconds)
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
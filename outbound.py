@@ -0,0 +1,212 @@
+# outbound.py
+import threading
+import socket
+import time
+from collections import deque
+
+# What to do when a client's outbound queue is full
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+FLUSH_BYTES = 256 * 1024  # most bytes gathered into one vectored write
+IOV_MAX = 1024  # buffers per sendmsg call; Linux rejects more
+
+
+def send_vectored(sock, frames):
+    """Write frames with as few sendmsg calls as possible; returns the calls made"""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))
+        return 1
+    views = [memoryview(frame) for frame in frames]
+    start = 0
+    calls = 0
+    while start < len(views):
+        sent = sock.sendmsg(views[start:start + IOV_MAX])
+        calls += 1
+        # A partial write stops anywhere; resume from the first unsent byte
+        while sent and start < len(views):
+            if sent >= len(views[start]):
+                sent -= len(views[start])
+                start += 1
+            else:
+                views[start] = views[start][sent:]
+                sent = 0
+    return calls
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    Not thread-safe on its own; the writer that owns it does the locking.
+    Frames may carry a coalesce key (e.g. a room's presence update) so that,
+    under the coalesce policy, a newer frame supersedes the queued one with
+    the same key instead of pushing another frame out.
+    """
+
+    def __init__(self, max_frames=1024, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_frames = max_frames
+        self.policy = policy
+        self.entries = deque()  # [key, frame]; frame is None once superseded
+        self.keyed = {}  # {key: entry}
+        self.depth = 0
+        self.bytes = 0  # size of the live frames
+        self.stats = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'coalesced': 0, 'max_depth': 0,
+                      'bytes_sent': 0, 'flushes': 0, 'writes': 0, 'max_flush_frames': 0}
+
+    def push(self, frame, key=None):
+        """Queue a frame; returns False if the client should be disconnected"""
+        if self.depth >= self.max_frames:
+            if self.policy == DISCONNECT:
+                self.stats['dropped'] += 1
+                return False
+            if self.policy == COALESCE and key is not None and key in self.keyed:
+                superseded = self.keyed.pop(key)
+                self.bytes -= len(superseded[1])
+                superseded[1] = None
+                self.depth -= 1
+                self.stats['coalesced'] += 1
+            else:
+                self.drop_oldest()
+
+        entry = [key, frame]
+        self.entries.append(entry)
+        if key is not None:
+            self.keyed[key] = entry
+        self.depth += 1
+        self.bytes += len(frame)
+        self.stats['enqueued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+        return True
+
+    def drop_oldest(self):
+        """Discard the oldest live frame"""
+        while self.entries:
+            key, frame = self.entries.popleft()
+            if frame is not None:
+                self.forget(key)
+                self.depth -= 1
+                self.bytes -= len(frame)
+                self.stats['dropped'] += 1
+                return
+
+    def pop_all(self):
+        """Take every queued frame, oldest first"""
+        frames = [frame for key, frame in self.entries if frame is not None]
+        self.entries.clear()
+        self.keyed.clear()
+        self.depth = 0
+        self.bytes = 0
+        return frames
+
+    def pop_batch(self, max_bytes=FLUSH_BYTES):
+        """Take the oldest frames that fit in max_bytes, always at least one"""
+        frames = []
+        size = 0
+        while self.entries:
+            key, frame = self.entries[0]
+            if frame is not None:
+                if frames and size + len(frame) > max_bytes:
+                    break
+                frames.append(frame)
+                size += len(frame)
+                self.forget(key)
+            self.entries.popleft()
+        self.depth -= len(frames)
+        self.bytes -= size
+        return frames
+
+    def record_flush(self, frames, writes):
+        """Count one gathered write of `frames` that took `writes` system calls"""
+        self.stats['sent'] += len(frames)
+        self.stats['bytes_sent'] += sum(len(frame) for frame in frames)
+        self.stats['flushes'] += 1
+        self.stats['writes'] += writes
+        self.stats['max_flush_frames'] = max(self.stats['max_flush_frames'], len(frames))
+
+    def forget(self, key):
+        if key is not None:
+            self.keyed.pop(key, None)
+
+
+class QueuedSocketWriter:
+    """Dedicated writer thread draining an OutboundQueue into a blocking socket.
+
+    Everything queued while the previous write was in progress goes out in
+    one vectored sendmsg, up to flush_bytes. With a flush_interval the thread
+    also waits that long for a burst to gather, trading a little latency for
+    fewer system calls and fuller TCP segments.
+    """
+
+    def __init__(self, sock, max_frames=1024, policy=DROP_OLDEST, flush_interval=0.0,
+                 flush_bytes=FLUSH_BYTES):
+        self.sock = sock
+        self.queue = OutboundQueue(max_frames, policy)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send_frame(self, frame, key=None):
+        """Queue a frame without blocking the caller"""
+        with self.cond:
+            if self.closed:
+                return
+            if not self.queue.push(frame, key):
+                # Slow consumer: shut the socket so the reader thread cleans up
+                self.closed = True
+                self.abort()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue.depth and not self.closed:
+                    self.cond.wait()
+                if self.flush_interval:
+                    self.gather()
+                frames = self.queue.pop_batch(self.flush_bytes)
+                if not frames and self.closed:
+                    return
+            try:
+                writes = send_vectored(self.sock, frames)
+                with self.cond:
+                    self.queue.record_flush(frames, writes)
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                    self.queue.pop_all()
+                self.abort()
+                return
+
+    def gather(self):
+        """Wait up to flush_interval for more frames; caller holds self.cond"""
+        deadline = time.monotonic() + self.flush_interval
+        while self.queue.bytes < self.flush_bytes and not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.cond.wait(remaining)
+
+    def abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, timeout=5):
+        """Stop accepting frames and wait for queued ones to be written"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+    def stats(self):
+        with self.cond:
+            return dict(self.queue.stats, depth=self.queue.depth)
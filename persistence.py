@@ -0,0 +1,138 @@
+# persistence.py
+import sqlite3
+import threading
+import queue
+import time
+
+INSERT_MESSAGE = '''
+    INSERT INTO messages (id, username, room, message, timestamp, message_type, file_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+INDEX_MESSAGE = 'INSERT INTO messages_fts (rowid, message) VALUES (?, ?)'
+
+
+def connect(db_path):
+    """Open a SQLite connection in WAL mode so readers never block the writer"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # With WAL, NORMAL only syncs at checkpoints and remains corruption safe
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class MessageWriter:
+    """Background thread that group-commits message inserts from every handler.
+
+    Rows are committed once batch_size of them are pending or the oldest has
+    waited max_delay seconds, whichever comes first, so one fsync covers many
+    messages and callers never wait on disk. Rows not yet committed can be
+    read back with unwritten(), so readers never have to wait for a commit.
+    If a batch fails, its rows are retried one by one so a bad row only loses
+    itself; on_failed(rows) is told about the rows that could not be stored.
+    """
+
+    def __init__(self, db_path, batch_size=256, max_delay=0.05, on_failed=None):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_failed = on_failed
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = {}  # {message_id: row} submitted but not yet committed
+        self.stats = {
+            'batches': 0,
+            'rows': 0,
+            'max_batch': 0,
+            'errors': 0,
+            'rows_failed': 0,
+            'commit_seconds_total': 0.0,
+            'commit_seconds_max': 0.0,
+        }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, message_id, username, room, message, timestamp, msg_type='text', file_id=None):
+        """Queue a message row for the next batch"""
+        row = (message_id, username, room, message, timestamp, msg_type, file_id)
+        with self.lock:
+            self.queued[message_id] = row
+        self.pending.put(row)
+
+    def unwritten(self, room):
+        """Rows of `room` still waiting for their batch, as (id, username, message, timestamp, type, file_id)"""
+        with self.lock:
+            return sorted((row[0], row[1], row[3], row[4], row[5], row[6])
+                          for row in self.queued.values() if row[2] == room)
+
+    def run(self):
+        conn = connect(self.db_path)
+        while True:
+            row = self.pending.get()
+            if row is None:
+                break
+            batch = [row]
+            deadline = time.monotonic() + self.max_delay
+            stop = False
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    row = self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch.append(row)
+            self.write_batch(conn, batch)
+            if stop:
+                break
+        conn.close()
+
+    def insert(self, conn, rows):
+        with conn:
+            conn.executemany(INSERT_MESSAGE, rows)
+            # Same transaction, so the search index never disagrees with the table
+            conn.executemany(INDEX_MESSAGE, [(row[0], row[3]) for row in rows])
+
+    def write_batch(self, conn, batch):
+        started = time.perf_counter()
+        failed = []
+        try:
+            self.insert(conn, batch)
+        except sqlite3.Error as e:
+            print(f"Failed to persist a batch of {len(batch)} messages, retrying one by one: {e}")
+            with self.lock:
+                self.stats['errors'] += 1
+            for row in batch:
+                try:
+                    self.insert(conn, [row])
+                except sqlite3.Error as e:
+                    print(f"Dropping message {row[0]}: {e}")
+                    failed.append(row)
+        elapsed = time.perf_counter() - started
+
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['rows'] += len(batch) - len(failed)
+            self.stats['rows_failed'] += len(failed)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+            self.stats['commit_seconds_total'] += elapsed
+            self.stats['commit_seconds_max'] = max(self.stats['commit_seconds_max'], elapsed)
+            for row in batch:
+                self.queued.pop(row[0], None)
+        if failed and self.on_failed:
+            self.on_failed(failed)
+
+    def get_stats(self):
+        """Snapshot of batch sizes and commit latency"""
+        with self.lock:
+            stats = dict(self.stats, queued=len(self.queued))
+        batches = stats['batches'] or 1
+        stats['avg_batch'] = stats['rows'] / batches
+        stats['avg_commit_ms'] = stats['commit_seconds_total'] * 1000 / batches
+        return stats
+
+    def close(self, timeout=10):
+        """Commit whatever is queued and stop the writer thread"""
+        self.pending.put(None)
+        self.thread.join(timeout)
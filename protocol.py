@@ -0,0 +1,97 @@
+# protocol.py
+import struct
+import json
+
+# Every frame on the wire is a 4-byte big-endian length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_SIZE = 65536
+
+# Raw bytes ride after the JSON header, separated by a NUL that json.dumps never emits
+ATTACHMENT_SEPARATOR = b'\0'
+
+
+class FrameError(Exception):
+    """Raised when a peer sends a malformed or oversized frame"""
+
+
+def encode_frame(payload, max_frame_size=MAX_FRAME_SIZE):
+    """Prefix a payload with its length header"""
+    if len(payload) > max_frame_size:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds limit of {max_frame_size}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload, max_frame_size=MAX_FRAME_SIZE):
+    """Write a single frame, retrying until every byte is sent"""
+    sock.sendall(encode_frame(payload, max_frame_size))
+
+
+def encode_body(message):
+    """Serialize a message; a bytes 'chunk' field is appended raw instead of base64-encoded"""
+    chunk = message.get('chunk')
+    if chunk is None:
+        return json.dumps(message).encode()
+    header = {key: value for key, value in message.items() if key != 'chunk'}
+    return json.dumps(header).encode() + ATTACHMENT_SEPARATOR + chunk
+
+
+def decode_body(body):
+    """Inverse of encode_body"""
+    header, separator, chunk = body.partition(ATTACHMENT_SEPARATOR)
+    message = json.loads(header.decode())
+    if separator:
+        message['chunk'] = chunk
+    return message
+
+
+class FrameDecoder:
+    """Incremental decoder that turns a byte stream into complete frames"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes to the buffer"""
+        self.buffer.extend(data)
+
+    def next_frame(self):
+        """Pop the next complete frame, or return None if one is not buffered yet"""
+        if len(self.buffer) < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self.buffer)
+        if length > self.max_frame_size:
+            raise FrameError(f"Incoming frame of {length} bytes exceeds limit of {self.max_frame_size}")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[HEADER.size:end])
+        del self.buffer[:end]
+        return payload
+
+    def pending(self):
+        """Number of buffered bytes not yet returned as frames"""
+        return len(self.buffer)
+
+
+class FrameReader:
+    """Buffered blocking reader that returns whole frames from a socket"""
+
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.recv_size = recv_size
+        self.decoder = FrameDecoder(max_frame_size)
+
+    def read_frame(self):
+        """Return the next frame, or None when the peer closes cleanly"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                if self.decoder.pending():
+                    raise FrameError("Connection closed in the middle of a frame")
+                return None
+            self.decoder.feed(data)
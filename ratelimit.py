@@ -0,0 +1,107 @@
+# ratelimit.py
+import threading
+import time
+
+USER_MESSAGES = 10.0  # messages/sec a user may sustain
+USER_BYTES = 256 * 1024  # payload bytes/sec a user may sustain
+ROOM_MESSAGES = 200.0  # messages/sec across everyone in a room
+BURST_SECONDS = 2.0  # a quiet bucket holds this many seconds of its rate
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """Seconds until `amount` tokens are available, 0 when they are now"""
+        # A request larger than the bucket passes once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets per user (messages and bytes) and per room (messages).
+
+    A request is charged to every bucket or to none, so a frame the room
+    rejects does not also use up the sender's allowance. A rate of 0 turns
+    that limit off. Buckets are per server process; with several workers
+    the room limit applies on each of them.
+    """
+
+    def __init__(self, user_messages=USER_MESSAGES, user_bytes=USER_BYTES,
+                 room_messages=ROOM_MESSAGES, burst_seconds=BURST_SECONDS):
+        self.limits = {'user_messages': user_messages, 'user_bytes': user_bytes,
+                       'room_messages': room_messages}
+        self.burst_seconds = burst_seconds
+        self.buckets = {}  # {(scope, user or room): TokenBucket}
+        self.lock = threading.Lock()
+        self.last_prune = time.monotonic()
+        self.stats = {'allowed': 0, 'throttled_user_messages': 0, 'throttled_user_bytes': 0,
+                      'throttled_room_messages': 0, 'paced': 0}
+
+    def bucket(self, scope, key, now):
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            rate = self.limits[scope]
+            bucket = self.buckets[scope, key] = TokenBucket(rate, rate * self.burst_seconds, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def check(self, username, room, size, messages=1):
+        """Charge `messages` messages of `size` bytes; returns None, or (scope, retry_after) when throttled"""
+        now = time.monotonic()
+        wanted = (('user_messages', username, messages), ('user_bytes', username, size),
+                  ('room_messages', room, messages))
+        with self.lock:
+            charges = [(self.bucket(scope, key, now), scope, amount)
+                       for scope, key, amount in wanted if self.limits[scope] and amount]
+            for bucket, scope, amount in charges:
+                retry_after = bucket.wait_for(amount)
+                if retry_after:
+                    self.stats['throttled_' + scope] += 1
+                    return scope, retry_after
+            for bucket, _, amount in charges:
+                bucket.tokens -= min(amount, bucket.capacity)
+            self.stats['allowed'] += 1
+            if now - self.last_prune >= PRUNE_INTERVAL:
+                self.prune(now)
+        return None
+
+    def pace(self, username, size, most):
+        """Charge `size` bytes to the user even past its allowance; returns the seconds until
+        that debt is paid off, or None (nothing charged) if more than `most` bytes are owed already"""
+        if not self.limits['user_bytes']:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.bucket('user_bytes', username, now)
+            if bucket.tokens < -most:
+                self.stats['throttled_user_bytes'] += 1
+                return None
+            bucket.tokens -= size
+            if bucket.tokens >= 0:
+                self.stats['allowed'] += 1
+                return 0.0
+            self.stats['paced'] += 1
+            return -bucket.tokens / bucket.rate
+
+    def prune(self, now):
+        # Caller holds self.lock; a bucket that has refilled is the same as a new one
+        self.last_prune = now
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, buckets=len(self.buckets))
@@ -0,0 +1,172 @@
+# schema.py
+# Versioned migrations for chat_data.db; PRAGMA user_version records the applied version
+
+
+def create_tables(conn):
+    """v1: the original users and messages tables"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            room TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            message_type TEXT DEFAULT 'text'
+        )
+    ''')
+
+
+def index_messages_by_room(conn):
+    """v2: integer epoch timestamps and a (room, id) index for history range scans"""
+    conn.execute('''
+        CREATE TABLE messages_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            room TEXT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            message_type TEXT DEFAULT 'text'
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_v2 (id, username, room, message, timestamp, message_type)
+        SELECT id, username, room, message,
+               COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), 0), message_type
+        FROM messages
+    ''')
+    conn.execute('DROP TABLE messages')
+    conn.execute('ALTER TABLE messages_v2 RENAME TO messages')
+    conn.execute('CREATE INDEX idx_messages_room_id ON messages (room, id)')
+
+
+def add_blob_store(conn):
+    """v3: content-addressed blobs, per-upload file records, and file references on messages"""
+    conn.execute('''
+        CREATE TABLE blobs (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE files (
+            file_id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL REFERENCES blobs (hash),
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            username TEXT,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('ALTER TABLE messages ADD COLUMN file_id TEXT')
+
+
+def add_sessions(conn):
+    """v4: login session tokens, stored as SHA-256 hashes"""
+    conn.execute('''
+        CREATE TABLE sessions (
+            token_hash TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def add_message_search(conn):
+    """v5: FTS5 index over message text, kept in sync by the message writer"""
+    # External content: the index stores only tokens and reads text back from messages
+    conn.execute('''
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            message,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def add_message_archive(conn):
+    """v6: index of the compressed segments holding messages moved out of the live table"""
+    conn.execute('''
+        CREATE TABLE archive_segments (
+            id INTEGER PRIMARY KEY,
+            room TEXT NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            start_time INTEGER NOT NULL,
+            end_time INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            path TEXT NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_archive_segments_room ON archive_segments (room, last_id)')
+
+
+def drop_blob_refcount(conn):
+    """v7: blobs are never reclaimed, so their reference counts go"""
+    conn.execute('ALTER TABLE blobs DROP COLUMN refcount')
+
+
+MIGRATIONS = [
+    create_tables,
+    index_messages_by_room,
+    add_blob_store,
+    add_sessions,
+    add_message_search,
+    add_message_archive,
+    drop_blob_refcount,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn):
+    """Apply every migration newer than the database's version, each in its own transaction"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema v{version} is newer than this server (v{SCHEMA_VERSION})")
+
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        conn.execute('BEGIN')
+        try:
+            MIGRATIONS[target - 1](conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migrated database to schema v{target}")
+
+
+def message_rooms(conn):
+    """Distinct rooms with stored messages, walked through the (room, id) index instead of a table scan"""
+    rows = conn.execute('''
+        WITH RECURSIVE r(room) AS (
+            SELECT MIN(room) FROM messages
+            UNION ALL
+            SELECT (SELECT MIN(room) FROM messages WHERE room > r.room)
+            FROM r WHERE r.room IS NOT NULL
+        )
+        SELECT room FROM r WHERE room IS NOT NULL
+    ''').fetchall()
+    return [room for (room,) in rows]
+
+
+def last_message_id(conn):
+    """Highest message ID ever issued, including rows that were later deleted"""
+    row = conn.execute('''
+        SELECT MAX(COALESCE((SELECT MAX(id) FROM messages), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0))
+    ''').fetchone()
+    return row[0]
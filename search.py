@@ -0,0 +1,86 @@
+# search.py
+import re
+import threading
+import time
+import persistence
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE = 100
+# Control characters around matched terms in snippets; they never occur in typed text
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+SNIPPET_TOKENS = 16
+
+TERM = re.compile(r'\w+\*?')
+
+
+def fts_query(text):
+    """Turn free text into a safe FTS5 query: every word must match, 'word*' is a prefix"""
+    terms = []
+    for term in TERM.findall(text):
+        prefix = term.endswith('*')
+        word = term.rstrip('*')
+        terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return ' '.join(terms)
+
+
+class MessageSearch:
+    """Full-text search over stored messages through the messages_fts index.
+
+    Results come newest first and are paged with a before_id cursor like
+    history. The index walks rowids in descending order, so a page stops as
+    soon as it has enough matches instead of ranking every hit.
+    """
+
+    def __init__(self, db_path):
+        self.conn = persistence.connect(db_path)
+        self.lock = threading.Lock()
+        self.stats = {'searches': 0, 'search_seconds_total': 0.0, 'search_seconds_max': 0.0}
+
+    def search(self, text, room=None, username=None, since=None, until=None,
+               before_id=None, limit=SEARCH_PAGE_SIZE):
+        """Return (rows, next_before_id); rows are
+        (id, room, username, timestamp, message_type, file_id, snippet)"""
+        query = fts_query(text)
+        if not query:
+            return [], None
+
+        filters = ['messages_fts MATCH ?']
+        params = [query]
+        for clause, value in (('m.room = ?', room), ('m.username = ?', username),
+                              ('m.timestamp >= ?', since), ('m.timestamp < ?', until),
+                              ('messages_fts.rowid < ?', before_id)):
+            if value is not None:
+                filters.append(clause)
+                params.append(value)
+
+        sql = f'''
+            SELECT m.id, m.room, m.username, m.timestamp, m.message_type, m.file_id,
+                   snippet(messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '...', {SNIPPET_TOKENS})
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            WHERE {' AND '.join(filters)}
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        '''
+        started = time.perf_counter()
+        with self.lock:
+            rows = self.conn.execute(sql, params + [limit]).fetchall()
+            elapsed = time.perf_counter() - started
+            self.stats['searches'] += 1
+            self.stats['search_seconds_total'] += elapsed
+            self.stats['search_seconds_max'] = max(self.stats['search_seconds_max'], elapsed)
+
+        next_before_id = rows[-1][0] if len(rows) == limit else None
+        return rows, next_before_id
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['avg_search_ms'] = (stats['search_seconds_total'] / stats['searches'] * 1000
+                                  if stats['searches'] else 0.0)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
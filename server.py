@@ -1,231 +1,1194 @@
 # chat_server.py
 import socket
+import argparse
 import threading
-import json
-import sqlite3
-import hashlib
+import concurrent.futures
 import base64
 import os
 from datetime import datetime
+from collections import namedtuple
 from cryptography.fernet import Fernet
+import protocol
+import outbound
+import persistence
+import history
+import schema
+import time
+import uuid
+import transfer
+import blobstore
+import codec
+import auth
+import search
+import metrics
+import timers
+import ratelimit
+import archive
+
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE = 200
+RESUME_LIMIT = 500  # missed messages replayed on resume before the client is told to reload
+HEARTBEAT_INTERVAL = 30  # seconds of silence before the server pings a connection
+IDLE_TIMEOUT = 90  # seconds of silence, pings included, before it is dropped
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 512  # one turn covers IDLE_TIMEOUT, so deadlines rarely wait extra rounds
+# Label values for per-action metrics; anything else a client sends counts as 'unknown'
+ACTIONS = frozenset(('hello', 'register', 'login', 'join_room', 'resume', 'fetch_users',
+                     'fetch_history', 'search_messages', 'send_message', 'send_file',
+                     'upload_start', 'upload_chunk', 'download_file', 'download_ack',
+                     'ping', 'pong'))
+# Requests that need a logged-in user; anything else from an anonymous connection is refused
+LOGIN_REQUIRED_ACTIONS = frozenset(('join_room', 'send_message', 'send_file', 'upload_start',
+                                    'upload_chunk', 'download_file', 'download_ack'))
+# Requests that are stored and fanned out to a room go through the rate limiter; upload
+# chunks are paced by their acks instead
+RATE_LIMITED_ACTIONS = ('send_message', 'send_file', 'upload_start')
+# Type and help of every component stat exported by collect_metrics; counters get a
+# _total suffix. A stat missing from here is not exported.
+C, G = 'counter', 'gauge'
+COMPONENT_METRICS = {
+    'outbound': {
+        'enqueued': (C, 'Frames queued for clients'),
+        'sent': (C, 'Frames written to clients'),
+        'dropped': (C, 'Frames dropped by the slow consumer policy'),
+        'coalesced': (C, 'Queued frames replaced by a newer frame with the same key'),
+        'flushes': (C, 'Times a client writer drained its queue'),
+        'writes': (C, 'Vectored socket writes to clients'),
+        'depth': (G, 'Frames waiting in outbound queues'),
+        'max_depth': (G, 'Deepest outbound queue of a current connection'),
+        'connections': (G, 'Connections with an outbound queue'),
+        'frames_per_write': (G, 'Frames sent per socket write since startup'),
+        'max_flush_frames': (G, 'Most frames one flush of a current connection has sent'),
+    },
+    'persistence': {
+        'batches': (C, 'Group commits of the message writer'),
+        'rows': (C, 'Messages committed'),
+        'errors': (C, 'Group commits that failed and were retried row by row'),
+        'rows_failed': (C, 'Messages that could not be stored and were dropped'),
+        'commit_seconds_total': (C, 'Time spent committing message batches'),
+        'max_batch': (G, 'Largest group commit so far'),
+        'commit_seconds_max': (G, 'Slowest group commit so far'),
+        'queued': (G, 'Messages waiting for a group commit'),
+    },
+    'history': {
+        'hits': (C, 'History lookups answered by the in-memory cache'),
+        'misses': (C, 'History lookups that went to the database'),
+        'rooms': (G, 'Rooms in the history cache'),
+        'messages': (G, 'Messages in the history cache'),
+    },
+    'presence': {
+        'events': (C, 'Joins and leaves'),
+        'coalesced': (C, 'Joins and leaves merged into a pending presence delta'),
+        'deltas_sent': (C, 'Presence deltas sent to rooms'),
+        'max_batch': (G, 'Most users in one presence delta so far'),
+        'pending_rooms': (G, 'Rooms with a presence delta waiting for its window'),
+    },
+    'search': {
+        'searches': (C, 'Full-text searches'),
+        'search_seconds_total': (C, 'Time spent in full-text searches'),
+        'search_seconds_max': (G, 'Slowest full-text search so far'),
+    },
+    'blobs': {
+        'blobs_written': (C, 'Distinct file contents stored'),
+        'dedup_hits': (C, 'Uploads whose content was already stored'),
+        'bytes_deduplicated': (C, 'Upload bytes not stored again'),
+        'bytes_served': (C, 'File bytes read for downloads'),
+        'open_maps': (G, 'Blobs currently memory-mapped'),
+        'blobs': (G, 'Stored blobs'),
+        'blob_bytes': (G, 'Bytes in stored blobs'),
+    },
+    'compression': {
+        'frames': (C, 'Frame bodies offered to the compressors'),
+        'compressed': (C, 'Frame bodies sent deflated'),
+        'bytes_in': (C, 'Bytes of the deflated frame bodies before compression'),
+        'bytes_out': (C, 'Bytes of the deflated frame bodies after compression'),
+        'compress_seconds': (C, 'Time spent compressing frames'),
+        'decompressed': (C, 'Deflated frames received'),
+        'decompress_seconds': (C, 'Time spent decompressing frames'),
+    },
+    'heartbeat': {
+        'pings': (C, 'Pings sent to quiet connections'),
+        'evicted': (C, 'Connections dropped after the idle timeout'),
+        'watched': (G, 'Connections under heartbeat supervision'),
+    },
+    'rate_limit': {
+        'allowed': (C, 'Rate-limited requests let through'),
+        'throttled_user_messages': (C, 'Requests refused by a user message limit'),
+        'throttled_user_bytes': (C, 'Requests refused by a user byte limit'),
+        'throttled_room_messages': (C, 'Requests refused by a room message limit'),
+        'paced': (C, 'Upload chunks acknowledged late to hold the sender to its byte limit'),
+        'buckets': (G, 'Token buckets in use'),
+    },
+    'archive': {
+        'reads': (C, 'History reads that went to the archive'),
+        'segments_loaded': (C, 'Archive segments read and decompressed'),
+        'segment_cache_hits': (C, 'Archive segment reads served from the decoded LRU'),
+        'compactions': (C, 'Compaction runs'),
+        'rows_archived': (C, 'Messages moved into the archive'),
+        'segments_written': (C, 'Archive segments written'),
+        'bytes_written': (C, 'Compressed bytes written to archive segments'),
+        'errors': (C, 'Compaction runs that failed'),
+        'compact_seconds_last': (G, 'Duration of the last compaction run'),
+        'cached_segments': (G, 'Decoded archive segments held in memory'),
+        'segments': (G, 'Archive segments'),
+        'archived_rows': (G, 'Messages held in the archive'),
+        'archive_bytes': (G, 'Compressed bytes in the archive'),
+    },
+    'auth': {
+        'kdf_hashes': (C, 'Password hashes computed'),
+        'password_logins': (C, 'Logins with a password'),
+        'token_logins': (C, 'Logins and resumes with a session token'),
+        'failed_logins': (C, 'Logins and token checks refused'),
+        'rehashed': (C, 'Legacy password hashes upgraded'),
+        'sessions': (G, 'Session tokens cached in memory'),
+        'queued': (G, 'Password hashes waiting for an auth worker'),
+    },
+    'cluster': {
+        'published': (C, 'Events this worker published on the bus'),
+        'received': (C, 'Events this worker received from the bus'),
+        'dropped': (C, 'Bus events dropped because the broker fell behind'),
+        'depth': (G, 'Events waiting to be written to the bus'),
+    },
+}
+del C, G
+
+# Slow work handed to a pool by handle_action (logins, and under asyncio anything that
+# blocks on disk); each engine waits on the future in its own way and then calls
+# then(result) for that connection
+Deferred = namedtuple('Deferred', ['future', 'then'])
+
+class ClientConnection:
+    """Blocking socket connection served by a reader thread and a writer thread"""
+    
+    def __init__(self, sock, address, max_frames=1024, policy=outbound.DROP_OLDEST,
+                 flush_interval=0.0, flush_bytes=outbound.FLUSH_BYTES):
+        self.sock = sock
+        self.address = address
+        self.username = None
+        self.room = None
+        self.downloads = {}  # {file_id: transfer.Download}
+        self.bytes_received = 0
+        self.last_active = time.monotonic()  # when the last frame arrived
+        self.disconnected = False
+        self.writer = outbound.QueuedSocketWriter(sock, max_frames, policy, flush_interval, flush_bytes)
+    
+    def send_frame(self, frame, key=None):
+        """Queue an encoded frame for the writer thread"""
+        self.writer.send_frame(frame, key)
+    
+    def outbound_stats(self):
+        return self.writer.stats()
+    
+    def abort(self):
+        """Drop a dead or silent peer; the reader thread then cleans up"""
+        self.writer.abort()
+    
+    def close(self):
+        self.writer.close()
+        self.sock.close()
 
 class ChatServer:
-    def __init__(self, host='127.0.0.1', port=5555):
+    def __init__(self, host='127.0.0.1', port=5555, max_frame_size=protocol.MAX_FRAME_SIZE,
+                 outbound_queue_size=1024, slow_consumer_policy=outbound.DROP_OLDEST,
+                 db_path='chat_data.db', persist_batch_size=256, persist_max_delay=0.05,
+                 history_cache_size=200, upload_dir='uploads', max_upload_size=transfer.MAX_UPLOAD_SIZE,
+                 upload_ttl=transfer.UPLOAD_TTL,
+                 blob_dir='blobs', codecs=('binary', 'json'), ciphers=codec.CIPHERS,
+                 auth_workers=4, kdf_iterations=auth.KDF_ITERATIONS, session_ttl=auth.SESSION_TTL,
+                 presence_window=0.15, worker_id=0, workers=1, reuse_port=False, bus_path=None,
+                 metrics_port=None, flush_interval=0.0, flush_bytes=outbound.FLUSH_BYTES,
+                 compression=tuple(codec.COMPRESSORS), compress_threshold=codec.COMPRESS_THRESHOLD,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 user_message_rate=ratelimit.USER_MESSAGES, user_byte_rate=ratelimit.USER_BYTES,
+                 room_message_rate=ratelimit.ROOM_MESSAGES, archive_dir='archive',
+                 retain_rows=archive.HOT_ROWS, retain_age=archive.HOT_AGE,
+                 compact_interval=archive.COMPACT_INTERVAL):
         self.host = host
         self.port = port
+        self.max_frame_size = max_frame_size
+        self.outbound_queue_size = outbound_queue_size
+        self.slow_consumer_policy = slow_consumer_policy
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.outbound_totals = {'enqueued': 0, 'sent': 0, 'dropped': 0, 'coalesced': 0, 'bytes_sent': 0,
+                                'flushes': 0, 'writes': 0}
+        self.bytes_received_total = 0  # from connections that have closed
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}  # {username: (socket, cipher)}
-        self.rooms = {'General': [], 'Random': [], 'Tech': []}
+        if reuse_port:
+            # Every worker of a cluster listens on the same port; the kernel balances accepts
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.worker_id = worker_id
+        self.workers = workers
+        self.bus_path = bus_path
+        self.bus = None  # cluster.Bus once connected to the other workers
+        self.clients = {}  # {username: connection}
+        self.rooms = {'General': set(), 'Random': set(), 'Tech': set()}
+        self.room_versions = dict.fromkeys(self.rooms, 0)  # bumped on every membership change
+        self.presence_lock = threading.Lock()  # keeps versions and delta order in step
+        self.presence_window = presence_window
+        self.pending_presence = {}  # {room: {'since': version, 'users': touched usernames}}
+        self.presence_counters = {'events': 0, 'coalesced': 0, 'deltas_sent': 0, 'max_batch': 0}
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        # Every connection sits in the wheel once, at its next heartbeat check
+        self.idle_wheel = timers.TimerWheel(WHEEL_TICK, WHEEL_SLOTS, time.monotonic())
+        self.heartbeat_counters = {'pings': 0, 'evicted': 0}
+        self.rate_limiter = ratelimit.RateLimiter(user_message_rate, user_byte_rate, room_message_rate)
         self.encryption_key = Fernet.generate_key()
-        self.cipher = Fernet(self.encryption_key)
+        # JSON + Fernet is what clients speak until they negotiate something else with 'hello'
+        self.codecs = [name for name in codecs if name in codec.CODECS]
+        self.ciphers = [name for name in ciphers if name in codec.CIPHERS]
+        # One compressor per algorithm, shared by its wire formats so its counters cover every client
+        self.compressors = {name: codec.COMPRESSORS[name](compress_threshold, max_size=max_frame_size)
+                            for name in compression if name in codec.COMPRESSORS}
+        self.aesgcm = codec.AesGcmCipher()
+        self.wire_formats = {}
+        self.default_wire = self.wire_format('json', 'fernet')
+        self.db_path = db_path
+        self.db_lock = threading.Lock()  # guards self.conn/self.cursor across client threads
         self.init_database()
+        self.history = history.HistoryCache(history_cache_size)
+        self.archive = archive.MessageArchive(archive_dir, db_path)
+        self.load_history_cache()
+        self.message_writer = persistence.MessageWriter(db_path, persist_batch_size, persist_max_delay,
+                                                        self.unstored_messages)
+        self.blobs = blobstore.BlobStore(blob_dir, db_path)
+        self.files = transfer.FileStore(self.blobs, upload_dir, max_upload_size, upload_ttl)
+        self.message_search = search.MessageSearch(db_path)
+        self.auth = auth.Authenticator(db_path, auth_workers, kdf_iterations, session_ttl)
+        if worker_id == 0:
+            # Workers share the database, so one of them compacts for the cluster
+            self.archive.start(retain_rows, retain_age, compact_interval, self.archived)
+        self.metrics_port = metrics_port
+        self.metrics_server = None  # metrics.MetricsServer once started
+        self.init_metrics()
         
     def init_database(self):
         """Initialize SQLite database for users and messages"""
-        self.conn = sqlite3.connect('chat_data.db', check_same_thread=False)
+        self.conn = persistence.connect(self.db_path)
         self.cursor = self.conn.cursor()
         
-        # Users table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Messages table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                room TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                message_type TEXT DEFAULT 'text'
-            )
-        ''')
-        
-        self.conn.commit()
-        
-    def hash_password(self, password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        schema.migrate(self.conn)
+        self.last_message_id = schema.last_message_id(self.conn)
+        self.message_lock = threading.Lock()  # keeps IDs, cache order and write order in step
+        
+    def load_history_cache(self):
+        """Fill each room's ring buffer with its newest stored messages"""
+        for room in self.archive.rooms():
+            self.history.mark_partial(room)
+        with self.db_lock:
+            for room in schema.message_rooms(self.conn):
+                rows = self.cursor.execute('''
+                    SELECT room, id, username, message, timestamp, message_type, file_id
+                    FROM messages
+                    WHERE room=?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (room, self.history.capacity)).fetchall()
+                self.history.load(reversed(rows))
+    
+    def init_metrics(self):
+        """Declare the hot-path metrics; gauges are collected when scraped"""
+        self.metrics = metrics.Metrics()
+        self.metrics.describe('chat_action_seconds', 'histogram',
+                              'Time to decode and handle one client request, by action')
+        self.metrics.describe('chat_fanout_recipients', 'histogram',
+                              'Connections on this process a broadcast was queued for')
+        self.metrics.describe('chat_fanout_seconds', 'histogram',
+                              'Time to encode a broadcast and queue it for every recipient')
+        self.metrics.describe('chat_save_message_seconds', 'histogram',
+                              'Time to assign a message ID, cache it and queue it for commit')
+        self.metrics.describe('chat_history_seconds', 'histogram',
+                              'History lookups by query and by whether the cache, the database or the archive answered')
+        self.metrics.add_collector(self.collect_metrics)
+    
+    def start_metrics(self):
+        """Serve /metrics and /profile on localhost when a metrics port is configured"""
+        if self.metrics_port:
+            # Workers of a cluster take consecutive ports
+            port = self.metrics_port + self.worker_id
+            self.metrics_server = metrics.MetricsServer('127.0.0.1', port, self.metrics)
+            print(f"Metrics on http://127.0.0.1:{port}/metrics")
+    
+    def collect_metrics(self):
+        """Gauges read at scrape time: clients, rooms, traffic and every component's stats"""
+        outbound_stats = self.outbound_stats()
+        clients = list(self.clients.items())
+        flushes = [((('user', username),), conn.outbound_stats()) for username, conn in clients]
+        families = [
+            ('chat_connected_clients', 'gauge', 'Logged-in connections on this process',
+             [((), len(clients))]),
+            ('chat_connection_flushes_total', 'counter', 'Times each connection drained its outbound queue',
+             [(labels, stats['flushes']) for labels, stats in flushes]),
+            ('chat_connection_frames_per_write', 'gauge', 'Frames sent per socket write on each connection',
+             [(labels, stats['sent'] / stats['writes'] if stats['writes'] else 0.0)
+              for labels, stats in flushes]),
+            ('chat_connection_max_flush_frames', 'gauge', 'Most frames one flush of each connection has sent',
+             [(labels, stats['max_flush_frames']) for labels, stats in flushes]),
+            ('chat_room_members', 'gauge', 'Members of each room on this process',
+             [((('room', room),), len(members)) for room, members in list(self.rooms.items())]),
+            ('chat_bytes_received_total', 'counter', 'Frame bytes read from clients',
+             [((), self.bytes_received_total + sum(conn.bytes_received for _, conn in clients))]),
+            ('chat_bytes_sent_total', 'counter', 'Frame bytes written to clients',
+             [((), outbound_stats['bytes_sent'])]),
+        ]
+        components = (('outbound', outbound_stats), ('persistence', self.persistence_stats()),
+                      ('history', self.history_stats()), ('presence', self.presence_stats()),
+                      ('search', self.search_stats()), ('blobs', self.blob_stats()),
+                      ('compression', self.compression_stats()), ('heartbeat', self.heartbeat_stats()),
+                      ('rate_limit', self.rate_limit_stats()), ('archive', self.archive_stats()),
+                      ('auth', self.auth.get_stats()), ('cluster', self.cluster_stats()))
+        for component, stats in components:
+            described = COMPONENT_METRICS[component]
+            for key, value in stats.items():
+                if key not in described:
+                    continue
+                kind, help_text = described[key]
+                name = f'chat_{component}_{key}'
+                if kind == 'counter' and not name.endswith('_total'):
+                    name += '_total'
+                families.append((name, kind, help_text, [((), value)]))
+        return families
+    
+    def dispatch(self, conn, encrypted_data):
+        """Decode and handle one client frame, recording its size and handling time"""
+        started = time.perf_counter()
+        conn.last_active = time.monotonic()
+        conn.bytes_received += protocol.HEADER.size + len(encrypted_data)
+        data = self.decode_message(conn, encrypted_data)
+        pending = self.handle_action(conn, data)
+        action = data.get('action')
+        self.metrics.observe('chat_action_seconds', time.perf_counter() - started,
+                             (('action', action if action in ACTIONS else 'unknown'),))
+        return pending
     
     def register_user(self, username, password):
-        """Register a new user"""
-        try:
-            hashed_pw = self.hash_password(password)
-            self.cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)',
-                              (username, hashed_pw))
-            self.conn.commit()
-            return True, "Registration successful!"
-        except sqlite3.IntegrityError:
-            return False, "Username already exists!"
-        except Exception as e:
-            return False, f"Registration failed: {str(e)}"
+        """Register a new user; returns a future resolving to (success, message)"""
+        return self.auth.register(username, password)
     
     def authenticate_user(self, username, password):
-        """Authenticate user login"""
-        hashed_pw = self.hash_password(password)
-        self.cursor.execute('SELECT * FROM users WHERE username=? AND password=?',
-                          (username, hashed_pw))
-        return self.cursor.execute('SELECT * FROM users WHERE username=? AND password=?',
-                                  (username, hashed_pw)).fetchone() is not None
-    
-    def save_message(self, username, room, message, msg_type='text'):
-        """Save message to database"""
-        self.cursor.execute('''
-            INSERT INTO messages (username, room, message, message_type) 
-            VALUES (?, ?, ?, ?)
-        ''', (username, room, message, msg_type))
-        self.conn.commit()
-    
-    def get_message_history(self, room, limit=50):
-        """Retrieve message history for a room"""
-        self.cursor.execute('''
-            SELECT username, message, timestamp, message_type 
-            FROM messages 
-            WHERE room=? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (room, limit))
-        messages = self.cursor.fetchall()
-        return list(reversed(messages))
-    
-    def broadcast(self, message, room, sender=None):
-        """Broadcast message to all users in a room"""
-        encrypted_msg = self.cipher.encrypt(json.dumps(message).encode())
-        
-        for username in self.rooms.get(room, []):
-            if username != sender and username in self.clients:
-                try:
-                    client_socket = self.clients[username][0]
-                    client_socket.send(encrypted_msg)
-                except:
-                    self.remove_client(username)
+        """Check a login; returns a future resolving to True or False"""
+        return self.auth.authenticate(username, password)
+    
+    def format_timestamp(self, timestamp):
+        """Render an epoch timestamp the way clients display it"""
+        return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    
+    def save_message(self, username, room, message, msg_type='text', file_id=None):
+        """Assign the next message ID and queue the message for the next group commit"""
+        started = time.perf_counter()
+        timestamp = int(time.time())
+        with self.message_lock:
+            # Workers of a cluster each take every workers-th ID, so IDs never collide
+            message_id = self.last_message_id + 1
+            message_id += (self.worker_id - message_id) % self.workers
+            self.last_message_id = message_id
+            row = (message_id, username, message, timestamp, msg_type, file_id)
+            self.history.append(room, row)
+            self.message_writer.submit(message_id, username, room, message, timestamp, msg_type, file_id)
+        if self.bus:
+            self.bus.publish({'type': 'history', 'room': room, 'row': row})
+        self.metrics.observe('chat_save_message_seconds', time.perf_counter() - started)
+        return message_id, timestamp
+    
+    def history_row(self, row):
+        """Wire format of a history entry: (username, message, timestamp, type, id, file)"""
+        message_id, username, message, timestamp, msg_type, file_id = row
+        file = None
+        if file_id:
+            info = self.blobs.file_info(file_id)
+            if info:
+                file = {'file_id': file_id, 'filename': info['filename'], 'size': info['size']}
+        return (username, message, self.format_timestamp(timestamp), msg_type, message_id, file)
+    
+    def get_message_history(self, room, limit=HISTORY_PAGE_SIZE, before_id=None):
+        """Retrieve up to `limit` messages older than before_id (newest when None)"""
+        started = time.perf_counter()
+        messages = self.history.recent(room, limit, before_id)
+        source = 'cache'
+        if messages is None:
+            source = 'db'
+            # Older than the ring buffer reaches. Rows still queued for commit are read first,
+            # so one committed in between is only seen twice, never missed
+            upper = before_id if before_id is not None else self.last_message_id + 1
+            unwritten = [row for row in self.message_writer.unwritten(room) if row[0] < upper]
+            with self.db_lock:
+                self.cursor.execute('''
+                    SELECT id, username, message, timestamp, message_type, file_id 
+                    FROM messages 
+                    WHERE room=? AND id < ?
+                    ORDER BY id DESC 
+                    LIMIT ?
+                ''', (room, upper, limit))
+                messages = self.merge_unwritten(self.cursor.fetchall(), unwritten)[-limit:]
+            if len(messages) < limit:
+                # The table ran out: everything older than its first row is archived
+                source = 'archive'
+                oldest = messages[0][0] if messages else upper
+                messages = self.archive.older(room, oldest, limit - len(messages)) + messages
+        self.metrics.observe('chat_history_seconds', time.perf_counter() - started,
+                             (('query', 'page'), ('source', source)))
+        return [self.history_row(row) for row in messages]
+    
+    def merge_unwritten(self, rows, unwritten):
+        """Stored rows plus rows still queued for commit, oldest first, each once"""
+        return sorted({row[0]: row for row in list(rows) + unwritten}.values())
+    
+    def search_result(self, row):
+        """Wire format of a search hit; the snippet marks matches with search.HIGHLIGHT_START/END"""
+        message_id, room, username, timestamp, msg_type, file_id, snippet = row
+        result = {
+            'id': message_id,
+            'room': room,
+            'username': username,
+            'timestamp': self.format_timestamp(timestamp),
+            'type': msg_type,
+            'snippet': snippet
+        }
+        if file_id:
+            result['file_id'] = file_id
+        return result
+    
+    def history_page(self, room, limit=HISTORY_PAGE_SIZE, before_id=None):
+        """A history page plus the cursor for the next older page (None when exhausted)"""
+        messages = self.get_message_history(room, limit, before_id)
+        next_before_id = messages[0][4] if messages and len(messages) == limit else None
+        return messages, next_before_id
+    
+    def messages_since(self, room, after_id, limit=RESUME_LIMIT):
+        """Messages newer than after_id, oldest first, or None when more than limit were missed"""
+        started = time.perf_counter()
+        rows = self.history.since(room, after_id, limit + 1)
+        source = 'cache'
+        if rows is None:
+            source = 'db'
+            unwritten = [row for row in self.message_writer.unwritten(room) if row[0] > after_id]
+            with self.db_lock:
+                rows = self.cursor.execute('''
+                    SELECT id, username, message, timestamp, message_type, file_id
+                    FROM messages
+                    WHERE room=? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (room, after_id, limit + 1)).fetchall()
+            rows = self.merge_unwritten(rows, unwritten)[:limit + 1]
+            # Archived rows all precede the first hot one, which bounds the archive read
+            archived = self.archive.newer(room, after_id, limit + 1, rows[0][0] if rows else None)
+            if archived:
+                source = 'archive'
+                rows = (archived + rows)[:limit + 1]
+        self.metrics.observe('chat_history_seconds', time.perf_counter() - started,
+                             (('query', 'since'), ('source', source)))
+        if len(rows) > limit:
+            return None
+        return [self.history_row(row) for row in rows]
+    
+    def unstored_messages(self, rows):
+        """The writer could not store these rows; stop serving them from the cache"""
+        for row in rows:
+            message_id, room = row[0], row[2]
+            self.history.discard(room, message_id)
+            if self.bus:
+                self.bus.publish({'type': 'unstored', 'room': room, 'id': message_id})
+    
+    def archived(self, room):
+        """The compactor moved some of a room's messages into the archive; runs on its thread"""
+        self.history.mark_partial(room)
+        if self.bus:
+            self.bus.publish({'type': 'archived', 'room': room})
+    
+    def archive_stats(self):
+        """Rows and segments moved by the compactor and archive reads by history"""
+        return self.archive.get_stats()
+    
+    def persistence_stats(self):
+        """Batch sizes and commit latency of the message writer"""
+        return self.message_writer.get_stats()
+    
+    def history_stats(self):
+        """Hit/miss counters of the in-memory history cache"""
+        return self.history.get_stats()
+    
+    def presence_stats(self):
+        """Join/leave events, how many were merged into a pending batch, and deltas sent"""
+        with self.presence_lock:
+            return dict(self.presence_counters, pending_rooms=len(self.pending_presence))
+    
+    def search_stats(self):
+        """Search count and latency"""
+        return self.message_search.get_stats()
+    
+    def blob_stats(self):
+        """Deduplication and read counters of the blob store"""
+        return self.blobs.get_stats()
+    
+    def compression_stats(self):
+        """Frames compressed, bytes saved and CPU spent, over every compressor"""
+        stats = {'frames': 0, 'compressed': 0, 'bytes_in': 0, 'bytes_out': 0,
+                 'compress_seconds': 0.0, 'decompressed': 0, 'decompress_seconds': 0.0}
+        for compressor in self.compressors.values():
+            for name, value in compressor.get_stats().items():
+                if name in stats:
+                    stats[name] += value
+        stats['ratio'] = stats['bytes_in'] / stats['bytes_out'] if stats['bytes_out'] else 1.0
+        return stats
+    
+    def wire_format(self, codec_name, cipher_name, compression=None):
+        """Shared WireFormat instance for a codec/cipher/compressor combination"""
+        key = (codec_name, cipher_name, compression)
+        if key not in self.wire_formats:
+            cipher = self.aesgcm if cipher_name == 'aesgcm' else codec.FernetCipher(self.encryption_key)
+            self.wire_formats[key] = codec.WireFormat(codec.CODECS[codec_name](), cipher,
+                                                      self.compressors.get(compression))
+        return self.wire_formats[key]
+    
+    def encode_message(self, message, wire=None):
+        """Encode and encrypt a message and wrap it in a length-prefixed frame"""
+        encrypted_msg = (wire or self.default_wire).encode(message)
+        return protocol.encode_frame(encrypted_msg, self.max_frame_size)
+    
+    def send_to(self, conn, message):
+        """Send a single message to one client"""
+        conn.send_frame(self.encode_message(message, conn.wire))
+    
+    def decode_message(self, conn, encrypted_data):
+        """Decrypt and parse a frame received from a client"""
+        return conn.wire.decode(encrypted_data)
+    
+    def broadcast(self, message, room, sender=None, coalesce_key=None):
+        """Broadcast message to all users in a room, including those on other workers"""
+        self.fan_out(message, room, sender, coalesce_key)
+        if self.bus:
+            self.bus.publish({'type': 'broadcast', 'room': room, 'message': message,
+                              'sender': sender, 'coalesce_key': coalesce_key})
+    
+    def fan_out(self, message, room, sender=None, coalesce_key=None):
+        """Send a message to the room's members connected to this process"""
+        # Encode once per wire format; each member's writer only gets a reference to the frame
+        started = time.perf_counter()
+        frames = {}
+        recipients = 0
+        
+        for username in list(self.rooms.get(room, ())):
+            conn = self.clients.get(username)
+            if username != sender and conn:
+                frame = frames.get(conn.wire.name)
+                if frame is None:
+                    frame = frames[conn.wire.name] = self.encode_message(message, conn.wire)
+                conn.send_frame(frame, coalesce_key)
+                recipients += 1
+        
+        self.metrics.observe('chat_fanout_seconds', time.perf_counter() - started)
+        self.metrics.observe('chat_fanout_recipients', recipients, buckets=metrics.SIZE_BUCKETS)
+    
+    def outbound_stats(self):
+        """Outbound queue counters summed over current and past connections"""
+        stats = dict(self.outbound_totals, depth=0, max_depth=0, max_flush_frames=0, connections=0)
+        for conn in list(self.clients.values()):
+            conn_stats = conn.outbound_stats()
+            for name in self.outbound_totals:
+                stats[name] += conn_stats[name]
+            stats['depth'] += conn_stats['depth']
+            stats['max_depth'] = max(stats['max_depth'], conn_stats['max_depth'])
+            stats['max_flush_frames'] = max(stats['max_flush_frames'], conn_stats['max_flush_frames'])
+            stats['connections'] += 1
+        stats['frames_per_write'] = stats['sent'] / stats['writes'] if stats['writes'] else 0.0
+        return stats
     
     def handle_client(self, client_socket, address):
         """Handle individual client connection"""
-        username = None
-        current_room = None
+        conn = ClientConnection(client_socket, address, self.outbound_queue_size,
+                                self.slow_consumer_policy, self.flush_interval, self.flush_bytes)
+        conn.wire = self.default_wire
+        self.watch(conn)
         
         try:
             # Send encryption key to client
-            client_socket.send(self.encryption_key)
+            conn.send_frame(protocol.encode_frame(self.encryption_key))
+            reader = protocol.FrameReader(client_socket, self.max_frame_size)
             
             while True:
-                encrypted_data = client_socket.recv(4096)
-                if not encrypted_data:
+                encrypted_data = reader.read_frame()
+                if encrypted_data is None:
                     break
                 
-                data = json.loads(self.cipher.decrypt(encrypted_data).decode())
-                action = data.get('action')
-                
-                if action == 'register':
-                    success, msg = self.register_user(data['username'], data['password'])
-                    response = {'action': 'register_response', 'success': success, 'message': msg}
-                    client_socket.send(self.cipher.encrypt(json.dumps(response).encode()))
-                
-                elif action == 'login':
-                    if self.authenticate_user(data['username'], data['password']):
-                        username = data['username']
-                        self.clients[username] = (client_socket, self.cipher)
-                        response = {
-                            'action': 'login_response', 
-                            'success': True, 
-                            'message': 'Login successful!',
-                            'rooms': list(self.rooms.keys())
-                        }
-                        client_socket.send(self.cipher.encrypt(json.dumps(response).encode()))
-                    else:
-                        response = {'action': 'login_response', 'success': False, 
-                                  'message': 'Invalid credentials!'}
-                        client_socket.send(self.cipher.encrypt(json.dumps(response).encode()))
-                
-                elif action == 'join_room':
-                    room = data['room']
-                    if current_room:
-                        self.rooms[current_room].remove(username)
-                    
-                    current_room = room
-                    if room not in self.rooms:
-                        self.rooms[room] = []
-                    self.rooms[room].append(username)
-                    
-                    # Send message history
-                    history = self.get_message_history(room)
-                    response = {
-                        'action': 'room_joined',
-                        'room': room,
-                        'history': history,
-                        'users': self.rooms[room]
-                    }
-                    client_socket.send(self.cipher.encrypt(json.dumps(response).encode()))
-                    
-                    # Notify others
-                    self.broadcast({
-                        'action': 'user_joined',
-                        'username': username,
-                        'room': room,
-                        'users': self.rooms[room]
-                    }, room, username)
-                
-                elif action == 'send_message':
-                    msg = data['message']
-                    msg_type = data.get('type', 'text')
-                    room = data['room']
-                    
-                    self.save_message(username, room, msg, msg_type)
-                    
-                    self.broadcast({
-                        'action': 'new_message',
-                        'username': username,
-                        'message': msg,
-                        'type': msg_type,
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }, room, username)
-                
-                elif action == 'send_file':
-                    room = data['room']
-                    filename = data['filename']
-                    filedata = data['filedata']
-                    
-                    self.save_message(username, room, f"[FILE:{filename}]", 'file')
-                    
-                    self.broadcast({
-                        'action': 'new_file',
-                        'username': username,
-                        'filename': filename,
-                        'filedata': filedata,
-                        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    }, room, username)
+                pending = self.dispatch(conn, encrypted_data)
+                if pending:
+                    # Only this client's thread waits; later requests stay in order behind it
+                    pending.then(pending.future.result())
         
         except Exception as e:
             print(f"Error handling client {address}: {e}")
         finally:
-            if username:
-                self.remove_client(username, current_room)
-            client_socket.close()
+            self.disconnect(conn)
+            conn.close()
+    
+    def handle_action(self, conn, data):
+        """Process one client request; shared by every server engine"""
+        action = data.get('action')
+        username = conn.username
+        
+        if action in LOGIN_REQUIRED_ACTIONS and username is None:
+            self.send_to(conn, {'action': 'error', 'request': action, 'message': 'Please log in first'})
+            return
+        
+        if action in RATE_LIMITED_ACTIONS and not self.within_rate_limit(conn, action, data):
+            return
+        
+        if action == 'hello':
+            self.negotiate(conn, data)
+        
+        elif action == 'register':
+            return Deferred(self.register_user(data['username'], data['password']),
+                            lambda result: self.finish_register(conn, result))
+        
+        elif action == 'login':
+            if data.get('token'):
+                self.finish_login(conn, data['username'],
+                                  self.auth.verify_token(data['username'], data['token']))
+            else:
+                return Deferred(self.authenticate_user(data['username'], data['password']),
+                                lambda valid: self.finish_login(conn, data['username'], valid))
+        
+        elif action == 'join_room':
+            room = data['room']
+            return Deferred(self.offload(self.history_page, room),
+                            lambda page: self.finish_join(conn, room, page))
+        
+        elif action == 'resume':
+            return Deferred(self.offload(self.resume_page, data),
+                            lambda page: self.finish_resume(conn, data, page))
+        
+        elif action == 'ping':
+            self.send_to(conn, {'action': 'pong'})
+        
+        elif action == 'pong':
+            pass  # dispatch already noted the activity
+        
+        elif action == 'fetch_users':
+            # A client that missed a presence delta resynchronises from a snapshot
+            with self.presence_lock:
+                users, version = self.presence_snapshot(data['room'])
+                self.send_to(conn, {
+                    'action': 'user_list',
+                    'room': data['room'],
+                    'users': users,
+                    'version': version
+                })
+        
+        elif action == 'fetch_history':
+            room = data['room']
+            limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), MAX_HISTORY_PAGE))
+            return Deferred(self.offload(self.history_page, room, limit, data.get('before_id')),
+                            lambda page: self.send_to(conn, {
+                                'action': 'history_page',
+                                'room': room,
+                                'messages': page[0],
+                                'next_before_id': page[1]
+                            }))
+        
+        elif action == 'search_messages':
+            limit = max(1, min(int(data.get('limit', search.SEARCH_PAGE_SIZE)), search.MAX_SEARCH_PAGE))
+            search_page = self.offload(self.message_search.search,
+                                       data.get('query', ''), data.get('room'), data.get('username'),
+                                       data.get('since'), data.get('until'), data.get('before_id'), limit)
+            return Deferred(search_page, lambda page: self.send_to(conn, {
+                'action': 'search_results',
+                'query': data.get('query', ''),
+                'before_id': data.get('before_id'),
+                'results': [self.search_result(row) for row in page[0]],
+                'next_before_id': page[1]
+            }))
+        
+        elif action == 'send_message':
+            msg = data['message']
+            msg_type = data.get('type', 'text')
+            room = data['room']
+            
+            message_id, timestamp = self.save_message(username, room, msg, msg_type)
+            
+            self.broadcast({
+                'action': 'new_message',
+                'id': message_id,
+                'username': username,
+                'message': msg,
+                'type': msg_type,
+                'timestamp': self.format_timestamp(timestamp)
+            }, room, username)
+            # The broadcast skips the sender, who still needs the ID for resuming
+            self.send_to(conn, {'action': 'message_saved', 'room': room, 'id': message_id})
+        
+        elif action == 'send_file':
+            # Legacy inline upload: store it and announce it like a chunked upload
+            file_id = uuid.uuid4().hex
+            content = base64.b64decode(data['filedata'])
+            return self.transfer_step(conn, file_id,
+                                      lambda: self.files.store(file_id, username, data['room'],
+                                                               data['filename'], content),
+                                      lambda upload: self.finish_send_file(conn, upload))
+        
+        elif action in ('upload_start', 'upload_chunk', 'download_file', 'download_ack'):
+            try:
+                return self.handle_transfer(conn, action, data)
+            except transfer.TransferError as e:
+                self.transfer_error(conn, data.get('file_id'), e)
+    
+    def finish_send_file(self, conn, upload):
+        message_id = self.announce_file(upload.username, upload.room, upload.file_id, upload.filename,
+                                        upload.size)
+        self.send_to(conn, {'action': 'message_saved', 'room': upload.room, 'id': message_id})
+    
+    def finish_join(self, conn, room, page):
+        """Enter a room once its history page has been read"""
+        history, next_before_id = page
+        with self.presence_lock:
+            users, version = self.enter_room(conn, room)
+            
+            # Send message history and a full member snapshot
+            response = {
+                'action': 'room_joined',
+                'room': room,
+                'history': history,
+                'next_before_id': next_before_id,
+                'users': users,
+                'version': version
+            }
+            self.send_to(conn, response)
+            
+            # Notify others
+            self.send_presence(room, added=[conn.username], sender=conn.username)
+    
+    def within_rate_limit(self, conn, action, data):
+        """Charge a write to its sender's and room's buckets; tells the client when it is throttled"""
+        if action == 'upload_start' and self.files.resumable(data['file_id'], conn.username):
+            # Already charged when the upload began; its chunks are paced by their acks
+            return True
+        payload = data.get('message') or data.get('filedata') or ''
+        throttled = self.rate_limiter.check(conn.username, data.get('room'),
+                                            len(payload.encode()), messages=1)
+        if throttled is None:
+            return True
+        
+        scope, retry_after = throttled
+        response = {
+            'action': 'rate_limited',
+            'request': action,
+            'room': data.get('room'),
+            'scope': scope,
+            'retry_after': round(retry_after, 3)
+        }
+        if data.get('file_id'):
+            response['file_id'] = data['file_id']
+        self.send_to(conn, response)
+        return False
+    
+    def rate_limit_stats(self):
+        """Writes allowed and throttled, by the limit that applied"""
+        return self.rate_limiter.get_stats()
+    
+    def enter_room(self, conn, room):
+        """Move a connection's user into a room; returns the member snapshot"""
+        # Caller holds self.presence_lock and announces the join after replying
+        if conn.room:
+            self.leave_room(conn.username, conn.room)
+        conn.room = room
+        self.rooms.setdefault(room, set()).add(conn.username)
+        self.room_versions[room] = self.room_versions.get(room, 0) + 1
+        self.publish_presence(room, added=[conn.username])
+        return self.presence_snapshot(room)
+    
+    def resume_page(self, data):
+        """Check a reconnecting client's token and read what it missed; None if the token is stale"""
+        if not self.auth.verify_token(data['username'], data.get('token', '')):
+            return None
+        room = data['room']
+        response = {'missed': {}, 'gaps': []}
+        # Only the room being resumed is replayed; joining another one later sends its history
+        last_seen_id = data.get('last_seen', {}).get(room)
+        if last_seen_id is not None and room in self.rooms:
+            rows = self.messages_since(room, last_seen_id)
+            if rows is None:
+                response['gaps'].append(room)
+            else:
+                response['missed'][room] = rows
+        if room not in response['missed']:
+            # Too far behind to replay (or never seen); send the newest page for a fresh start
+            response['history'], response['next_before_id'] = self.history_page(room)
+        return response
+    
+    def finish_resume(self, conn, data, page):
+        """Log a reconnecting client back in and replay only what it missed"""
+        if page is None:
+            self.send_to(conn, {'action': 'resume_response', 'success': False,
+                                'message': 'Session expired, please log in again'})
+            return
+        
+        username = data['username']
+        conn.username = username
+        self.clients[username] = conn
+        room = data['room']
+        response = {'action': 'resume_response', 'success': True, 'rooms': list(self.rooms.keys()),
+                    'room': room, **page}
+        
+        with self.presence_lock:
+            response['users'], response['version'] = self.enter_room(conn, room)
+            self.send_to(conn, response)
+            self.send_presence(room, added=[username], sender=username)
+    
+    def finish_register(self, conn, result):
+        success, msg = result
+        response = {'action': 'register_response', 'success': success, 'message': msg}
+        self.send_to(conn, response)
+    
+    def finish_login(self, conn, username, valid):
+        """Complete a login once its credentials have been checked"""
+        if valid:
+            conn.username = username
+            self.clients[conn.username] = conn
+            response = {
+                'action': 'login_response', 
+                'success': True, 
+                'message': 'Login successful!',
+                'rooms': list(self.rooms.keys()),
+                'token': self.auth.issue_token(username)
+            }
+        else:
+            response = {'action': 'login_response', 'success': False, 
+                      'message': 'Invalid credentials!'}
+        self.send_to(conn, response)
+    
+    def negotiate(self, conn, data):
+        """Pick the client's preferred codec and cipher that this server allows"""
+        codec_name = codec.choose(data.get('codecs'), self.codecs) or 'json'
+        cipher_name = codec.choose(data.get('ciphers'), self.ciphers) or 'fernet'
+        # Older clients offer no compression and keep getting uncompressed frames
+        compression = codec.choose(data.get('compression'), self.compressors)
+        response = {'action': 'hello_response', 'codec': codec_name, 'cipher': cipher_name,
+                    'compression': compression}
+        if cipher_name == 'aesgcm':
+            response['key'] = codec.encode_key(self.aesgcm.key)
+        
+        # The answer still goes out in the old format; everything after uses the new one
+        self.send_to(conn, response)
+        conn.wire = self.wire_format(codec_name, cipher_name, compression)
+    
+    def handle_transfer(self, conn, action, data):
+        """Chunked uploads and on-demand downloads"""
+        file_id = data['file_id']
+        
+        if action == 'upload_start':
+            # Resuming re-reads the bytes already on disk, and an empty file finishes at once
+            def begin():
+                upload = self.files.begin_upload(file_id, conn.username, data['room'],
+                                                 data['filename'], int(data['size']))
+                return self.files.finish_upload(file_id) if upload.received == upload.size else upload
+            
+            def ready(upload):
+                self.send_to(conn, {'action': 'upload_ready', 'file_id': file_id, 'offset': upload.received})
+                if upload.received == upload.size:
+                    self.complete_upload(conn, upload)
+            
+            return self.transfer_step(conn, file_id, begin, ready)
+        
+        elif action == 'upload_chunk':
+            # File content counts against the sender's bytes. Rather than refusing a chunk, the server
+            # holds back its ack until the bytes are paid for, so the sender's window stalls.
+            # Only a sender ignoring its window gets refused.
+            delay = self.rate_limiter.pace(conn.username, len(data['chunk']),
+                                           transfer.WINDOW_CHUNKS * transfer.CHUNK_SIZE)
+            if delay is None:
+                raise transfer.TransferError("Upload chunks sent faster than they were acknowledged")
+            def write():
+                upload = self.files.write_chunk(file_id, conn.username, data['offset'], data['chunk'])
+                return self.files.finish_upload(file_id) if upload.received == upload.size else upload
+            
+            def acknowledge(upload):
+                ack = {'action': 'upload_ack', 'file_id': file_id, 'offset': upload.received}
+                if upload.received == upload.size:
+                    self.complete_upload(conn, upload)
+                elif delay:
+                    self.schedule(delay, self.send_to, conn, ack)
+                else:
+                    self.send_to(conn, ack)
+            
+            return self.transfer_step(conn, file_id, write, acknowledge)
+        
+        elif action == 'download_file':
+            # Restarting a download from an earlier offset is how clients resume
+            offset = int(data.get('offset', 0))
+            info = self.blobs.file_info(file_id)
+            if info is None:
+                raise transfer.TransferError("Unknown file")
+            conn.downloads[file_id] = transfer.Download(file_id, info['size'], offset)
+            self.pump_download(conn, file_id)
+        
+        elif action == 'download_ack':
+            download = conn.downloads.get(file_id)
+            if download:
+                download.acked = max(download.acked, data['offset'])
+                self.pump_download(conn, file_id)
+    
+    def transfer_step(self, conn, file_id, work, then):
+        """Run blocking transfer work through offload; then(result) follows, or a transfer_error"""
+        def attempt():
+            try:
+                return work(), None
+            except transfer.TransferError as e:
+                return None, e
+        
+        def finish(outcome):
+            result, error = outcome
+            if error:
+                self.transfer_error(conn, file_id, error)
+            else:
+                then(result)
+        
+        return Deferred(self.offload(attempt), finish)
+    
+    def transfer_error(self, conn, file_id, error):
+        self.send_to(conn, {'action': 'transfer_error', 'file_id': file_id, 'message': str(error)})
+    
+    def complete_upload(self, conn, upload):
+        """Tell the room about an upload the blob store has taken"""
+        message_id = self.announce_file(upload.username, upload.room, upload.file_id,
+                                        upload.filename, upload.size)
+        self.send_to(conn, {'action': 'upload_complete', 'file_id': upload.file_id,
+                            'room': upload.room, 'id': message_id})
+    
+    def announce_file(self, username, room, file_id, filename, size):
+        """Record a file message and send the room a small announcement instead of the content"""
+        message_id, timestamp = self.save_message(username, room, f"[FILE:{filename}]", 'file', file_id)
+        self.broadcast({
+            'action': 'new_file',
+            'id': message_id,
+            'username': username,
+            'filename': filename,
+            'file_id': file_id,
+            'size': size,
+            'timestamp': self.format_timestamp(timestamp)
+        }, room, username)
+        return message_id
+    
+    def pump_download(self, conn, file_id):
+        """Send chunks until the download's window of unacknowledged bytes is full"""
+        download = conn.downloads[file_id]
+        while download.window_open():
+            chunk = self.blobs.read(file_id, download.sent, transfer.CHUNK_SIZE)
+            if not chunk:
+                break
+            self.send_to(conn, {
+                'action': 'file_chunk',
+                'file_id': file_id,
+                'offset': download.sent,
+                'size': download.size,
+                'chunk': chunk
+            })
+            download.sent += len(chunk)
+        if download.acked >= download.size:
+            del conn.downloads[file_id]
+    
+    def disconnect(self, conn):
+        """Clean up after a connection closes"""
+        conn.disconnected = True  # the idle wheel forgets it on its next check
+        # A resumed session may already own this username; leave it alone
+        if conn.username and self.clients.get(conn.username) is conn:
+            self.remove_client(conn.username, conn.room)
+        conn_stats = conn.outbound_stats()
+        for name in self.outbound_totals:
+            self.outbound_totals[name] += conn_stats[name]
+        self.bytes_received_total += conn.bytes_received
     
     def remove_client(self, username, room=None):
         """Remove client from server"""
         if username in self.clients:
             del self.clients[username]
         
-        if room and username in self.rooms.get(room, []):
-            self.rooms[room].remove(username)
-            self.broadcast({
-                'action': 'user_left',
-                'username': username,
-                'users': self.rooms[room]
-            }, room)
+        if room:
+            with self.presence_lock:
+                self.leave_room(username, room)
+    
+    def leave_room(self, username, room):
+        """Take a user out of a room and tell the members who remain"""
+        # Caller holds self.presence_lock
+        if username in self.rooms.get(room, ()):
+            self.rooms[room].discard(username)
+            self.room_versions[room] += 1
+            self.publish_presence(room, removed=[username])
+            self.send_presence(room, removed=[username])
+    
+    def presence_snapshot(self, room):
+        """Sorted member list and the version it reflects"""
+        return sorted(self.rooms.get(room, ())), self.room_versions.get(room, 0)
+    
+    def send_presence(self, room, added=(), removed=(), sender=None):
+        """Announce a membership change, batching changes within presence_window"""
+        # Caller holds self.presence_lock and has already bumped the version
+        version = self.room_versions[room]
+        self.presence_counters['events'] += 1
+        if not self.presence_window:
+            self.broadcast_presence(room, added, removed, version - 1, sender)
+            return
+        
+        pending = self.pending_presence.get(room)
+        if pending is None:
+            pending = self.pending_presence[room] = {'since': version - 1, 'users': set()}
+            self.schedule(self.presence_window, self.flush_presence, room)
+        else:
+            self.presence_counters['coalesced'] += 1
+        pending['users'].update(added, removed)
+    
+    def flush_presence(self, room):
+        """Send one delta for every change to a room since its window opened"""
+        with self.presence_lock:
+            pending = self.pending_presence.pop(room, None)
+            if pending is None:
+                return
+            # Report each touched user's final state, so a user who joined and left
+            # inside the window is listed as removed and the delta stays idempotent
+            members = self.rooms.get(room, set())
+            touched = pending['users']
+            self.broadcast_presence(room, sorted(touched & members), sorted(touched - members),
+                                    pending['since'])
+    
+    def broadcast_presence(self, room, added, removed, since, sender=None):
+        """Broadcast a membership delta taking the room from since to its current version"""
+        # A client whose queue drops or supersedes a delta sees 'since' run
+        # ahead of its own version and asks for a snapshot with fetch_users.
+        self.presence_counters['deltas_sent'] += 1
+        self.presence_counters['max_batch'] = max(self.presence_counters['max_batch'],
+                                               len(added) + len(removed))
+        self.fan_out({
+            'action': 'presence',
+            'room': room,
+            'added': list(added),
+            'removed': list(removed),
+            'since': since,
+            'version': self.room_versions[room]
+        }, room, sender, coalesce_key=('presence', room))
+    
+    def publish_presence(self, room, added=(), removed=()):
+        """Tell the other workers about a local membership change"""
+        # Each worker numbers presence versions for its own clients, so only the change is shared
+        if self.bus:
+            self.bus.publish({'type': 'presence', 'room': room,
+                              'added': list(added), 'removed': list(removed)})
+    
+    def connect_bus(self):
+        """Join the cluster's pub/sub bus when running as one of several workers"""
+        if self.bus_path:
+            import cluster
+            self.bus = cluster.Bus(self.bus_path, self.worker_id,
+                                   lambda event: self.call_soon(self.handle_bus_event, event))
+    
+    def handle_bus_event(self, event):
+        """Apply an event published by another worker"""
+        kind = event['type']
+        room = event['room']
+        
+        if kind == 'broadcast':
+            key = event['coalesce_key']
+            self.fan_out(event['message'], room, event['sender'], tuple(key) if key else None)
+        
+        elif kind == 'history':
+            row = tuple(event['row'])
+            with self.message_lock:
+                # Never issue an ID below one another worker has already used
+                self.last_message_id = max(self.last_message_id, row[0])
+                self.history.append(room, row)
+        
+        elif kind == 'archived':
+            self.history.mark_partial(room)
+        
+        elif kind == 'unstored':
+            self.history.discard(room, event['id'])
+        
+        elif kind == 'presence':
+            with self.presence_lock:
+                members = self.rooms.setdefault(room, set())
+                members.update(event['added'])
+                members.difference_update(event['removed'])
+                self.room_versions[room] = self.room_versions.get(room, 0) + 1
+                self.send_presence(room, event['added'], event['removed'])
+    
+    def cluster_stats(self):
+        """Bus traffic of this worker; empty when running as a single process"""
+        return self.bus.get_stats() if self.bus else {}
+    
+    def watch(self, conn):
+        """Put a new connection under heartbeat supervision"""
+        if self.heartbeat_interval:
+            self.idle_wheel.schedule(conn, conn.last_active + self.heartbeat_interval)
+    
+    def start_heartbeat(self):
+        if self.heartbeat_interval:
+            self.schedule(self.idle_wheel.tick, self.reap_idle)
+    
+    def reap_idle(self):
+        """Ping connections that went quiet and drop those that stayed silent; runs every tick"""
+        now = time.monotonic()
+        try:
+            for conn in self.idle_wheel.expire(now):
+                if conn.disconnected:
+                    continue
+                idle = now - conn.last_active
+                if idle >= self.idle_timeout:
+                    # Half-open or hung: its user must stop receiving broadcasts
+                    print(f"Dropping {conn.address} after {idle:.0f}s of silence")
+                    self.heartbeat_counters['evicted'] += 1
+                    conn.abort()
+                elif idle >= self.heartbeat_interval:
+                    self.heartbeat_counters['pings'] += 1
+                    self.send_to(conn, {'action': 'ping'})
+                    self.idle_wheel.schedule(conn, conn.last_active + self.idle_timeout)
+                else:
+                    self.idle_wheel.schedule(conn, conn.last_active + self.heartbeat_interval)
+        finally:
+            self.schedule(self.idle_wheel.tick, self.reap_idle)
+    
+    def start_upload_sweep(self):
+        if self.files.upload_ttl:
+            self.schedule(transfer.SWEEP_TICK, self.sweep_uploads)
+    
+    def sweep_uploads(self):
+        """Discard uploads abandoned for longer than the upload TTL; runs every sweep tick"""
+        try:
+            for file_id in self.files.expire_uploads():
+                print(f"Discarded abandoned upload {file_id}")
+        finally:
+            self.schedule(transfer.SWEEP_TICK, self.sweep_uploads)
+    
+    def heartbeat_stats(self):
+        """Connections supervised, pings sent and connections dropped for silence"""
+        return dict(self.heartbeat_counters, watched=len(self.idle_wheel))
+    
+    def offload(self, work, *args):
+        """Run blocking work(*args) for a request; returns a future. Here each client has its own
+        thread, so the work runs right away"""
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(work(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    
+    def call_soon(self, callback, *args):
+        """Run callback(*args) where connection state may be touched; here, right away"""
+        callback(*args)
+    
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds on a timer thread"""
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
     
     def start(self):
         """Start the chat server"""
         self.server.bind((self.host, self.port))
         self.server.listen()
+        self.connect_bus()
+        self.start_metrics()
+        self.start_heartbeat()
+        self.start_upload_sweep()
         print(f"Server started on {self.host}:{self.port}")
         
         while True:
@@ -234,7 +1197,138 @@ class ChatServer:
             thread = threading.Thread(target=self.handle_client, args=(client_socket, address))
             thread.daemon = True
             thread.start()
+    
+    def close(self):
+        """Flush pending messages and close the database"""
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.bus:
+            self.bus.close()
+        self.message_writer.close()
+        self.archive.close()
+        self.message_search.close()
+        self.auth.close()
+        self.blobs.close()
+        with self.db_lock:
+            self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--engine', choices=['threaded', 'asyncio'], default='threaded',
+                        help='threaded: one thread per client; asyncio: single event loop')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the port, linked by a local pub/sub bus')
+    parser.add_argument('--max-frame-size', type=int, default=protocol.MAX_FRAME_SIZE)
+    parser.add_argument('--outbound-queue-size', type=int, default=1024,
+                        help='frames buffered per client before the slow consumer policy applies')
+    parser.add_argument('--slow-consumer-policy', choices=outbound.POLICIES, default=outbound.DROP_OLDEST)
+    parser.add_argument('--flush-interval', type=float, default=0.0,
+                        help='seconds a client writer waits to gather frames into one write')
+    parser.add_argument('--flush-bytes', type=int, default=outbound.FLUSH_BYTES,
+                        help='most bytes sent to a client in one vectored write')
+    parser.add_argument('--db', default='chat_data.db')
+    parser.add_argument('--persist-batch-size', type=int, default=256,
+                        help='maximum messages per group commit')
+    parser.add_argument('--persist-max-delay', type=float, default=0.05,
+                        help='seconds a queued message may wait before its batch is committed')
+    parser.add_argument('--history-cache-size', type=int, default=200,
+                        help='recent messages kept in memory per room')
+    parser.add_argument('--upload-dir', default='uploads')
+    parser.add_argument('--max-upload-size', type=int, default=transfer.MAX_UPLOAD_SIZE)
+    parser.add_argument('--upload-ttl', type=float, default=transfer.UPLOAD_TTL,
+                        help='seconds an unfinished upload is kept without progress (0: forever)')
+    parser.add_argument('--blob-dir', default='blobs', help='content-addressed file storage')
+    parser.add_argument('--codecs', default='binary,json',
+                        help='serializers clients may negotiate, JSON is always allowed')
+    parser.add_argument('--ciphers', default=','.join(codec.CIPHERS),
+                        help='encryption clients may negotiate, Fernet is always allowed')
+    parser.add_argument('--compression', default=','.join(codec.COMPRESSORS),
+                        help='frame compression clients may negotiate, empty to disable')
+    parser.add_argument('--compress-threshold', type=int, default=codec.COMPRESS_THRESHOLD,
+                        help='bytes below which frame bodies are sent uncompressed')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds of silence before a client is pinged, 0 disables heartbeats')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds of silence after which a client is disconnected')
+    parser.add_argument('--user-message-rate', type=float, default=ratelimit.USER_MESSAGES,
+                        help='messages/sec each user may send, with bursts of twice that; 0 for no limit')
+    parser.add_argument('--user-byte-rate', type=float, default=ratelimit.USER_BYTES,
+                        help='message and inline file bytes/sec each user may send; 0 for no limit')
+    parser.add_argument('--room-message-rate', type=float, default=ratelimit.ROOM_MESSAGES,
+                        help='messages/sec accepted across a whole room; 0 for no limit')
+    parser.add_argument('--archive-dir', default='archive',
+                        help='compressed segments holding messages moved out of the database')
+    parser.add_argument('--retain-rows', type=int, default=archive.HOT_ROWS,
+                        help='newest messages per room kept in the database, older ones are archived; 0 for no limit')
+    parser.add_argument('--retain-days', type=float, default=archive.HOT_AGE / 86400,
+                        help='days messages stay in the database before they are archived; 0 for no limit')
+    parser.add_argument('--compact-interval', type=float, default=archive.COMPACT_INTERVAL,
+                        help='seconds between archive compactions')
+    parser.add_argument('--auth-workers', type=int, default=4,
+                        help='threads hashing passwords for register and login')
+    parser.add_argument('--kdf-iterations', type=int, default=auth.KDF_ITERATIONS,
+                        help='PBKDF2 rounds for new password hashes')
+    parser.add_argument('--presence-window', type=float, default=0.15,
+                        help='seconds to batch joins and leaves per room, 0 sends each at once')
+    parser.add_argument('--session-ttl', type=int, default=auth.SESSION_TTL,
+                        help='seconds a login token stays valid')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics and a sampling profiler on localhost (0: off)')
+    args = parser.parse_args()
+    
+    options = {
+        'host': args.host,
+        'port': args.port,
+        'max_frame_size': args.max_frame_size,
+        'outbound_queue_size': args.outbound_queue_size,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'flush_interval': args.flush_interval,
+        'flush_bytes': args.flush_bytes,
+        'db_path': args.db,
+        'persist_batch_size': args.persist_batch_size,
+        'persist_max_delay': args.persist_max_delay,
+        'history_cache_size': args.history_cache_size,
+        'upload_dir': args.upload_dir,
+        'max_upload_size': args.max_upload_size,
+        'upload_ttl': args.upload_ttl,
+        'blob_dir': args.blob_dir,
+        'codecs': args.codecs.split(','),
+        'ciphers': args.ciphers.split(','),
+        'compression': args.compression.split(','),
+        'compress_threshold': args.compress_threshold,
+        'heartbeat_interval': args.heartbeat_interval,
+        'idle_timeout': args.idle_timeout,
+        'user_message_rate': args.user_message_rate,
+        'user_byte_rate': args.user_byte_rate,
+        'room_message_rate': args.room_message_rate,
+        'archive_dir': args.archive_dir,
+        'retain_rows': args.retain_rows,
+        'retain_age': args.retain_days * 86400,
+        'compact_interval': args.compact_interval,
+        'auth_workers': args.auth_workers,
+        'kdf_iterations': args.kdf_iterations,
+        'session_ttl': args.session_ttl,
+        'presence_window': args.presence_window,
+        'metrics_port': args.metrics_port
+    }
+    if args.workers > 1:
+        import cluster
+        cluster.run(args.engine, options, args.workers)
+        return
+    if args.engine == 'asyncio':
+        from async_server import AsyncChatServer
+        server = AsyncChatServer(**options)
+    else:
+        server = ChatServer(**options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
 
 if __name__ == '__main__':
-    server = ChatServer()
-    server.start()
\ No newline at end of file
+    main()
@@ -0,0 +1,247 @@
+# test_components.py
+import sqlite3
+import pytest
+import archive
+import codec
+import history
+import outbound
+import persistence
+import protocol
+import schema
+import timers
+
+
+def test_outbound_drop_oldest_keeps_newest_frames():
+    queue = outbound.OutboundQueue(max_frames=2, policy=outbound.DROP_OLDEST)
+    for frame in (b'a', b'b', b'c'):
+        assert queue.push(frame)
+    assert queue.pop_all() == [b'b', b'c']
+    assert queue.stats['dropped'] == 1
+
+
+def test_outbound_disconnect_refuses_when_full():
+    queue = outbound.OutboundQueue(max_frames=1, policy=outbound.DISCONNECT)
+    assert queue.push(b'a')
+    assert not queue.push(b'b')
+    assert queue.pop_all() == [b'a']
+
+
+def test_outbound_coalesce_replaces_keyed_frame():
+    queue = outbound.OutboundQueue(max_frames=2, policy=outbound.COALESCE)
+    queue.push(b'old', key='presence')
+    queue.push(b'msg')
+    queue.push(b'new', key='presence')
+    assert queue.pop_all() == [b'msg', b'new']
+    assert queue.stats['coalesced'] == 1
+    assert queue.stats['dropped'] == 0
+
+
+def test_outbound_pop_batch_respects_byte_limit():
+    queue = outbound.OutboundQueue()
+    for frame in (b'x' * 4, b'y' * 4, b'z' * 4):
+        queue.push(frame)
+    assert queue.pop_batch(8) == [b'x' * 4, b'y' * 4]
+    # One frame always goes out, however large
+    assert queue.pop_batch(1) == [b'z' * 4]
+    assert queue.depth == 0 and queue.bytes == 0
+
+
+def test_outbound_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        outbound.OutboundQueue(policy='ignore')
+
+
+def test_frame_decoder_reassembles_split_frames():
+    stream = protocol.encode_frame(b'hello') + protocol.encode_frame(b'') + protocol.encode_frame(b'world')
+    decoder = protocol.FrameDecoder()
+    frames = []
+    for i in range(len(stream)):
+        decoder.feed(stream[i:i + 1])
+        frame = decoder.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = decoder.next_frame()
+    assert frames == [b'hello', b'', b'world']
+    assert decoder.pending() == 0
+
+
+def test_frame_decoder_rejects_oversized_frame():
+    decoder = protocol.FrameDecoder(max_frame_size=4)
+    decoder.feed(protocol.encode_frame(b'too long'))
+    with pytest.raises(protocol.FrameError):
+        decoder.next_frame()
+
+
+def test_timer_wheel_fires_on_deadline():
+    wheel = timers.TimerWheel(tick=1.0, slots=8, now=0.0)
+    wheel.schedule('soon', 2.0)
+    wheel.schedule('later', 5.5)
+    assert wheel.expire(1.0) == []
+    assert wheel.expire(2.0) == ['soon']
+    assert len(wheel) == 1
+    assert wheel.expire(6.0) == ['later']
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_keeps_deadlines_past_one_turn():
+    wheel = timers.TimerWheel(tick=1.0, slots=4, now=0.0)
+    wheel.schedule('far', 10.0)
+    assert wheel.expire(9.0) == []
+    assert wheel.expire(10.0) == ['far']
+
+
+def test_timer_wheel_catches_up_after_a_stall():
+    wheel = timers.TimerWheel(tick=1.0, slots=4, now=0.0)
+    wheel.schedule('a', 1.0)
+    wheel.schedule('b', 3.0)
+    assert sorted(wheel.expire(100.0)) == ['a', 'b']
+
+
+MESSAGE = {'action': 'new_message', 'id': 7, 'username': 'alice', 'message': 'héllo ✓',
+           'type': 'text', 'chunk': b'\x00\xff', 'users': ['bob', None], 'ratio': 1.5,
+           'big': 2 ** 40, 'negative': -3, 'flag': True}
+
+
+def test_binary_codec_round_trip():
+    binary = codec.BinaryCodec()
+    assert binary.decode(binary.encode(MESSAGE)) == MESSAGE
+
+
+def test_pure_python_packer_matches_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    out = bytearray()
+    codec.pack(MESSAGE, out)
+    assert msgpack.unpackb(bytes(out), raw=False) == MESSAGE
+    assert codec.unpack(msgpack.packb(MESSAGE, use_bin_type=True), 0)[0] == MESSAGE
+
+
+@pytest.mark.parametrize('compressor', [None, codec.ZlibCompressor, codec.ChatZlibCompressor])
+def test_wire_format_round_trip_with_aesgcm(compressor):
+    cipher = codec.AesGcmCipher()
+    sender = codec.WireFormat(codec.BinaryCodec(), cipher, compressor(threshold=0) if compressor else None)
+    receiver = codec.WireFormat(codec.BinaryCodec(), codec.AesGcmCipher(cipher.key),
+                                compressor() if compressor else None)
+    message = {'action': 'history_page', 'messages': [['alice', 'hi ' * 200, 'ts', 'text', 1, None]]}
+    assert receiver.decode(sender.encode(message)) == message
+
+
+def test_aesgcm_rejects_tampered_frame():
+    cipher = codec.AesGcmCipher()
+    frame = bytearray(cipher.encrypt(b'payload'))
+    frame[-1] ^= 1
+    with pytest.raises(Exception):
+        cipher.decrypt(bytes(frame))
+
+
+def test_decompression_is_bounded():
+    compressor = codec.ZlibCompressor(threshold=0, max_size=1000)
+    body = compressor.compress(b'a' * 5000)
+    with pytest.raises(codec.CodecError):
+        compressor.decompress(body)
+
+
+def row(message_id, text='m', timestamp=0):
+    return (message_id, 'alice', text, timestamp, 'text', None)
+
+
+def test_history_cache_serves_whole_room_until_full():
+    cache = history.HistoryCache(capacity=3)
+    cache.append('General', row(1))
+    cache.append('General', row(2))
+    assert [r[0] for r in cache.recent('General', 10)] == [1, 2]
+    assert cache.since('General', 1, 10) == [row(2)]
+    assert cache.recent('Empty', 10) == []
+
+
+def test_history_cache_misses_past_its_capacity():
+    cache = history.HistoryCache(capacity=3)
+    for message_id in range(1, 6):
+        cache.append('General', row(message_id))
+    assert [r[0] for r in cache.recent('General', 2)] == [4, 5]
+    assert cache.recent('General', 5) is None
+    assert cache.since('General', 1, 10) is None
+    assert [r[0] for r in cache.since('General', 3, 10)] == [4, 5]
+
+
+def test_history_cache_orders_late_rows_and_marks_partial():
+    cache = history.HistoryCache(capacity=3)
+    cache.append('General', row(1))
+    cache.append('General', row(3))
+    cache.append('General', row(2))
+    assert [r[0] for r in cache.recent('General', 3)] == [1, 2, 3]
+    cache.discard('General', 2)
+    # Was full, so rows older than the buffer may exist
+    assert cache.recent('General', 3) is None
+    cache.mark_partial('Random')
+    cache.append('Random', row(9))
+    assert cache.recent('Random', 5) is None
+
+
+def migrated(path):
+    conn = persistence.connect(str(path))
+    schema.migrate(conn)
+    return conn
+
+
+def insert_messages(conn, room, ids, timestamp):
+    rows = [(message_id, 'alice', room, f'message {message_id}', timestamp, 'text', None)
+            for message_id in ids]
+    with conn:
+        conn.executemany(persistence.INSERT_MESSAGE, rows)
+        conn.executemany(persistence.INDEX_MESSAGE, [(r[0], r[3]) for r in rows])
+
+
+def test_archive_compacts_oldest_rows_and_reads_them_back(tmp_path):
+    db_path = tmp_path / 'chat.db'
+    conn = migrated(db_path)
+    insert_messages(conn, 'General', range(1, 21), 1_000_000)
+    insert_messages(conn, 'Random', range(21, 24), 1_000_000)
+    store = archive.MessageArchive(str(tmp_path / 'archive'), str(db_path))
+    archived = []
+    try:
+        assert store.compact(conn, hot_rows=5, hot_age=0, on_archived=archived.append) == 15
+        assert archived == ['General']
+        hot = [r[0] for r in conn.execute("SELECT id FROM messages WHERE room='General' ORDER BY id")]
+        assert hot == list(range(16, 21))
+        assert [r[0] for r in store.older('General', 16, 4)] == [12, 13, 14, 15]
+        assert [r[0] for r in store.newer('General', 3, 3)] == [4, 5, 6]
+        assert store.newer('General', 15, 10) == []
+        assert store.rooms() == ['General']
+        # Archived rows leave the search index with their table rows
+        assert conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH '1'").fetchone()[0] == 0
+        assert store.get_stats()['archived_rows'] == 15
+    finally:
+        store.close()
+        conn.close()
+
+
+def test_schema_migrates_fresh_database(tmp_path):
+    conn = migrated(tmp_path / 'chat.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == schema.SCHEMA_VERSION
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert {'users', 'messages', 'blobs', 'files', 'sessions', 'messages_fts', 'archive_segments'} <= tables
+    # Already current: nothing to apply
+    schema.migrate(conn)
+    conn.close()
+
+
+def test_schema_upgrades_v1_rows(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'chat.db'))
+    schema.create_tables(conn)
+    conn.execute("INSERT INTO messages (username, room, message, timestamp) "
+                 "VALUES ('alice', 'General', 'hello', '2024-01-02 03:04:05')")
+    conn.execute('PRAGMA user_version = 1')
+    conn.commit()
+    schema.migrate(conn)
+    assert conn.execute('SELECT id, timestamp, file_id FROM messages').fetchall() == [(1, 1704164645, None)]
+    assert conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'hello'").fetchall() == [(1,)]
+    assert schema.message_rooms(conn) == ['General']
+    conn.close()
+
+
+def test_schema_refuses_newer_database(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'chat.db'))
+    conn.execute(f'PRAGMA user_version = {schema.SCHEMA_VERSION + 1}')
+    with pytest.raises(RuntimeError):
+        schema.migrate(conn)
+    conn.close()
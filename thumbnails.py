@@ -0,0 +1,100 @@
+# thumbnails.py
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+THUMBNAIL_SIZE = (300, 300)
+CACHE_BYTES = 64 * 1024 * 1024
+DECODE_WORKERS = 2
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+HASH_READ_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ThumbnailCache:
+    """Decoded thumbnails keyed by content hash, bounded by their pixel bytes.
+
+    The same picture posted again, or downloaded under another name, is
+    decoded once. The least recently used thumbnails are evicted past
+    max_bytes; images still on screen are kept alive by the widget's own
+    references, not by this cache.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {sha256: RGBA thumbnail}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, digest):
+        with self.lock:
+            image = self.entries.get(digest)
+            if image is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.stats['hits'] += 1
+            return image
+
+    def put(self, digest, image):
+        size = image.width * image.height * 4
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if digest in self.entries:
+                return
+            self.entries[digest] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.width * evicted.height * 4
+                self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes)
+
+
+class ThumbnailDecoder:
+    """Hashes and decodes images on a small pool so the UI thread only shows them.
+
+    deliver() is called on a pool thread with a 'thumbnail_ready' message;
+    the client queues it for the Tk loop like a server message.
+    """
+
+    def __init__(self, deliver, cache=None, workers=DECODE_WORKERS):
+        self.deliver = deliver
+        self.cache = cache or ThumbnailCache()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+
+    def submit(self, file_id, path, digest=None):
+        """Decode `path` in the background; digest skips hashing when already known"""
+        self.pool.submit(self.decode, file_id, path, digest)
+
+    def decode(self, file_id, path, digest):
+        try:
+            digest = digest or file_digest(path)
+            image = self.cache.get(digest)
+            if image is None:
+                with Image.open(path) as source:
+                    # JPEGs decode straight at a reduced scale
+                    source.draft('RGB', THUMBNAIL_SIZE)
+                    source.thumbnail(THUMBNAIL_SIZE)
+                    image = source.convert('RGBA')
+                self.cache.put(digest, image)
+            self.deliver({'action': 'thumbnail_ready', 'file_id': file_id, 'image': image})
+        except Exception as e:
+            print(f"Preview of {path} failed: {e}")
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
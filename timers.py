@@ -0,0 +1,48 @@
+# timers.py
+import math
+import threading
+
+
+class TimerWheel:
+    """Hashed timing wheel for large numbers of coarse deadlines.
+
+    Scheduling appends to one slot and each tick only looks at the slot that
+    came due, so the cost does not grow with the number of deadlines. There
+    is no cancel: the owner checks whether a key that fires is still relevant
+    and reschedules it if its deadline has moved. Deadlines more than one
+    turn of the wheel away stay in their slot for the extra rounds.
+    """
+
+    def __init__(self, tick=1.0, slots=512, now=0.0):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]  # [(tick number, key)]
+        self.current = int(now / tick)  # last tick processed
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, key, deadline):
+        """Fire `key` on the first tick at or after `deadline`"""
+        with self.lock:
+            due = max(math.ceil(deadline / self.tick), self.current + 1)
+            self.slots[due % len(self.slots)].append((due, key))
+            self.size += 1
+
+    def expire(self, now):
+        """Return the keys whose deadlines have passed, removing them from the wheel"""
+        expired = []
+        with self.lock:
+            target = int(now / self.tick)
+            # After a long stall, one pass over the wheel covers every slot
+            if target - self.current > len(self.slots):
+                self.current = target - len(self.slots)
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                later = [entry for entry in slot if entry[0] > target]
+                expired.extend(key for due, key in slot if due <= target)
+                slot[:] = later
+            self.size -= len(expired)
+        return expired
+
+    def __len__(self):
+        return self.size
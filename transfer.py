@@ -0,0 +1,184 @@
+# transfer.py
+import hashlib
+import os
+import re
+import threading
+import time
+import timers
+
+CHUNK_SIZE = 64 * 1024
+# Chunks a sender may have in flight before it waits for an acknowledgement
+WINDOW_CHUNKS = 8
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
+HASH_READ_SIZE = 1024 * 1024
+UPLOAD_TTL = 24 * 3600  # seconds an unfinished upload may sit idle before it is discarded
+SWEEP_TICK = 60
+
+FILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class TransferError(Exception):
+    """Raised for uploads or downloads the server refuses"""
+
+
+class Upload:
+    """Server-side state of one file being uploaded, hashed as its chunks arrive"""
+
+    def __init__(self, file_id, username, room, filename, size, path):
+        self.file_id = file_id
+        self.username = username
+        self.room = room
+        self.filename = filename
+        self.size = size
+        self.path = path
+        self.digest = hashlib.sha256()
+        self.received = 0
+        self.touched = time.monotonic()  # last chunk or resume
+        if os.path.exists(path):
+            # Left over from before a restart; only the bytes already on disk are read again
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                    self.digest.update(block)
+                    self.received += len(block)
+
+    def restart(self):
+        """Discard the bytes received so far"""
+        os.remove(self.path)
+        self.digest = hashlib.sha256()
+        self.received = 0
+
+
+class FileStore:
+    """Staging area for files being uploaded chunk by chunk.
+
+    Partial uploads live in <file_id>.part until the last byte arrives, so an
+    interrupted upload can resume from the bytes already on disk, even after a
+    server restart. Completed uploads are handed to the blob store; uploads
+    left idle for upload_ttl seconds are discarded along with their part files.
+    """
+
+    def __init__(self, blobs, directory='uploads', max_upload_size=MAX_UPLOAD_SIZE, upload_ttl=UPLOAD_TTL):
+        self.blobs = blobs
+        self.directory = directory
+        self.max_upload_size = max_upload_size
+        self.upload_ttl = upload_ttl
+        self.uploads = {}  # {file_id: Upload}
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        # Every upload, and every part file left from before a restart, sits in the wheel at its expiry
+        self.expiry = timers.TimerWheel(SWEEP_TICK, 1024, now)
+        self.expired = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            file_id, ext = os.path.splitext(name)
+            if ext == '.part' and FILE_ID.match(file_id):
+                self.expiry.schedule(file_id, now + self.time_left(file_id, now))
+
+    def path(self, file_id):
+        if not FILE_ID.match(file_id or ''):
+            raise TransferError("Invalid file id")
+        return os.path.join(self.directory, file_id + '.part')
+
+    def begin_upload(self, file_id, username, room, filename, size):
+        """Start or resume an upload; returns the Upload with its current offset"""
+        if not 0 <= size <= self.max_upload_size:
+            raise TransferError(f"Files are limited to {self.max_upload_size} bytes")
+        with self.lock:
+            upload = self.uploads.get(file_id)
+            if upload is None:
+                if self.blobs.file_info(file_id):
+                    raise TransferError("File already uploaded")
+                upload = Upload(file_id, username, room, os.path.basename(filename), size,
+                                self.path(file_id))
+                if upload.received > size:
+                    upload.restart()
+                self.uploads[file_id] = upload
+                self.expiry.schedule(file_id, upload.touched + self.upload_ttl)
+            elif upload.username != username:
+                raise TransferError("Upload belongs to another user")
+            upload.touched = time.monotonic()
+            return upload
+
+    def resumable(self, file_id, username):
+        """True if upload_start for file_id would pick up an upload already in progress"""
+        with self.lock:
+            upload = self.uploads.get(file_id)
+            if upload is not None:
+                return upload.username == username
+        return bool(FILE_ID.match(file_id or '')) and os.path.exists(self.path(file_id))
+
+    def write_chunk(self, file_id, username, offset, chunk):
+        """Append a chunk at the upload's current offset; returns the Upload"""
+        with self.lock:
+            upload = self.uploads.get(file_id)
+            if upload is None or upload.username != username:
+                raise TransferError("Unknown upload")
+            upload.touched = time.monotonic()
+            # Out-of-order or repeated chunks are ignored; the ack tells the sender where we are
+            if offset == upload.received and upload.received + len(chunk) <= upload.size:
+                with open(upload.path, 'ab') as f:
+                    f.write(chunk)
+                upload.digest.update(chunk)
+                upload.received += len(chunk)
+            return upload
+
+    def finish_upload(self, file_id):
+        """Hand a fully received upload to the blob store"""
+        with self.lock:
+            upload = self.uploads.pop(file_id)
+            if not os.path.exists(upload.path):
+                open(upload.path, 'wb').close()
+        self.blobs.add_file(file_id, upload.path, upload.filename, upload.username,
+                            upload.digest.hexdigest())
+        return upload
+
+    def store(self, file_id, username, room, filename, data):
+        """Save a file received in one piece"""
+        self.begin_upload(file_id, username, room, filename, len(data))
+        self.write_chunk(file_id, username, 0, data)
+        return self.finish_upload(file_id)
+
+    def time_left(self, file_id, now):
+        # Caller holds self.lock; seconds before the upload expires, None once it is gone
+        upload = self.uploads.get(file_id)
+        if upload is not None:
+            return upload.touched + self.upload_ttl - now
+        try:
+            idle = time.time() - os.path.getmtime(self.path(file_id))
+        except FileNotFoundError:
+            return None
+        return time.monotonic() - idle + self.upload_ttl - now
+
+    def expire_uploads(self, now=None):
+        """Discard the uploads and part files idle for upload_ttl; returns their file ids"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        for file_id in self.expiry.expire(now):
+            with self.lock:
+                left = self.time_left(file_id, now)
+                if left is None:
+                    continue  # finished, or its part file is already gone
+                if left > 0:
+                    self.expiry.schedule(file_id, now + left)
+                    continue
+                self.uploads.pop(file_id, None)
+                try:
+                    os.remove(self.path(file_id))
+                except FileNotFoundError:
+                    pass
+                self.expired += 1
+            expired.append(file_id)
+        return expired
+
+
+class Download:
+    """Server-side state of one file being streamed to one client"""
+
+    def __init__(self, file_id, size, offset):
+        self.file_id = file_id
+        self.size = size
+        self.sent = offset
+        self.acked = offset
+
+    def window_open(self):
+        return self.sent < self.size and self.sent - self.acked < WINDOW_CHUNKS * CHUNK_SIZE